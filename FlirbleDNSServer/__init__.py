@@ -28,14 +28,20 @@ version = "0.2"
 """Whether to emit extra diagnostic output."""
 debug = False
 
-"""Whether certain operations within a lock take a copy of an object or
-just a reference for use outside the lock. Might have performance versus
-robustness implications."""
-paranoid = True
-
 from server import *
+from supervisor import *
 from handler import *
+from eventloop import *
+from frozen import *
+from cache import *
+from counters import *
+from store import *
+from snapshot import *
+from wire import *
 from request import *
 from geo import *
+from grid import *
+from spatial import *
 from geodistance import *
 from data import *
+from filedata import *
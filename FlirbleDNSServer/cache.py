@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Bounded caches
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import threading, collections, time, heapq
+
+import FlirbleDNSServer as fdns
+
+"""The width, in seconds, of the buckets entries are grouped into by their
+   expiry time."""
+CACHE_EXPIRY_GRANULARITY = 1.0
+
+"""The maximum number of expired entries removed by each put()."""
+CACHE_EXPIRY_BATCH = 16
+
+
+"""
+A thread-safe cache with a bounded number of entries and least recently
+used eviction.
+
+Each entry may have an expiry time, after which it is treated as absent,
+and a set of tags. All the entries with a given tag can be removed at once
+with invalidate(), which lets callers drop exactly the entries that depend
+on some piece of data when that data changes. A value worked out from data
+read before an invalidate() could be put after it, and would then never be
+dropped; callers avoid this by reading self.generation before reading the
+data and passing it to put(), which ignores the value if anything has been
+invalidated since.
+
+Entries that expire are grouped into buckets by their expiry time, so that
+they can be removed without looking at the entries that have not. Each
+put() removes a few of them, and expire() removes all of them; either way
+the cost is in proportion to the number of expired entries, not the size
+of the cache.
+"""
+class LRUCache(object):
+
+    """The maximum number of entries."""
+    maxsize = None
+
+    """A lock around everything below."""
+    lock = None
+
+    """The entries, least recently used first. Each value is a tuple of
+    (value, expires, tags)."""
+    _entries = None
+
+    """The keys holding each tag."""
+    _tags = None
+
+    """The keys expiring in each bucket, indexed by bucket number; see
+    CACHE_EXPIRY_GRANULARITY."""
+    _buckets = None
+
+    """A heap of the numbers of the buckets in self._buckets, each once.
+    Buckets that have been emptied stay in both until _reap() removes
+    them."""
+    _bucket_heap = None
+
+    """Incremented by each invalidate(); see put()."""
+    generation = 0
+
+    """Counters; see stats()."""
+    hits = 0
+    misses = 0
+    expired = 0
+    evictions = 0
+    invalidated = 0
+    reaped = 0
+    stale = 0
+
+
+    """
+    @param maxsize int The maximum number of entries to hold.
+    """
+    def __init__(self, maxsize):
+        super(LRUCache, self).__init__()
+
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._tags = {}
+        self._buckets = {}
+        self._bucket_heap = []
+
+
+    """
+    Fetches an entry, marking it as recently used.
+
+    @param key object The key.
+    @param now float The current time, if the caller already has it.
+    @return object The value, or None if there is no current entry.
+    """
+    def get(self, key, now=None):
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires = entry[1]
+            if expires is not None:
+                if now is None:
+                    now = time.time()
+                if now >= expires:
+                    self._forget(key, entry)
+                    self.expired += 1
+                    self.misses += 1
+                    return None
+
+            # Re-insert to make it the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+
+    """
+    Adds or replaces an entry, evicting the least recently used entries if
+    the cache is full.
+
+    @param key object The key.
+    @param value object The value; None can not be stored.
+    @param expires float The time after which the entry is stale, or None
+                if it does not go stale by itself.
+    @param tags iterable Tags for invalidate().
+    @param now float The current time, if the caller already has it.
+    @param generation int The value of self.generation when the data the
+                value was worked out from was read; if anything has been
+                invalidated since, the value may be stale and is not
+                stored. None skips this check.
+    @return bool True if the entry was stored.
+    """
+    def put(self, key, value, expires=None, tags=(), now=None,
+            generation=None):
+        tags = frozenset(tags)
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                self.stale += 1
+                return False
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+
+            # Make room with expired entries before dropping live ones
+            self._reap(now, CACHE_EXPIRY_BATCH)
+
+            while len(self._entries) >= self.maxsize:
+                (k, e) = self._entries.popitem(last=False)
+                self._forget(k, e)
+                self.evictions += 1
+
+            self._entries[key] = (value, expires, tags)
+            for tag in tags:
+                if tag not in self._tags:
+                    self._tags[tag] = set()
+                self._tags[tag].add(key)
+            if expires is not None:
+                bucket = int(expires // CACHE_EXPIRY_GRANULARITY)
+                if bucket not in self._buckets:
+                    self._buckets[bucket] = set()
+                    heapq.heappush(self._bucket_heap, bucket)
+                self._buckets[bucket].add(key)
+            return True
+
+
+    """
+    Removes every expired entry.
+
+    @param now float The current time, if the caller already has it.
+    @return int The number of entries removed.
+    """
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return self._reap(now)
+
+
+    """
+    Removes every entry with any of the given tags.
+
+    @param tags iterable The tags.
+    @return int The number of entries removed.
+    """
+    def invalidate(self, tags):
+        count = 0
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._forget(key, entry)
+                        count += 1
+            self.invalidated += count
+        return count
+
+
+    """
+    Removes every entry.
+    """
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self._tags = {}
+            self._buckets = {}
+            self._bucket_heap = []
+
+
+    """
+    Returns a snapshot of the cache counters.
+
+    @return dict With these items:
+                * entries The number of entries held.
+                * hits The number of lookups that found a current entry.
+                * misses The number of lookups that did not.
+                * expired The number of lookups that found a stale entry.
+                * evictions The number of entries dropped to make room.
+                * invalidated The number of entries dropped by invalidate().
+                * reaped The number of expired entries removed before
+                    they were looked up.
+                * stale The number of entries not stored because they
+                    were worked out before an invalidate().
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'invalidated': self.invalidated,
+                'reaped': self.reaped,
+                'stale': self.stale,
+            }
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    """
+    Removes the tag references of an entry that has been taken out of the
+    cache. The lock must be held.
+    """
+    def _forget(self, key, entry):
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del(self._tags[tag])
+
+        if entry[1] is not None:
+            bucket = int(entry[1] // CACHE_EXPIRY_GRANULARITY)
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                # An empty bucket is kept, like its place in the heap, until
+                # _reap() gets to it; put() only pushes buckets it does not
+                # already have
+                keys.discard(key)
+
+
+    """
+    Removes expired entries, oldest bucket first. Only buckets that end
+    before the current time are emptied, so every entry in them has
+    expired; the others are left for get() to notice. The lock must be
+    held.
+
+    @param now float The current time.
+    @param limit int The maximum number of entries to remove, or None for
+                no limit.
+    @return int The number of entries removed.
+    """
+    def _reap(self, now, limit=None):
+        current = int(now // CACHE_EXPIRY_GRANULARITY)
+        heap = self._bucket_heap
+        count = 0
+        while len(heap) and heap[0] < current:
+            keys = self._buckets.get(heap[0])
+            while keys:
+                if limit is not None and count >= limit:
+                    self.reaped += count
+                    return count
+                key = keys.pop()
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._forget(key, entry)
+                    count += 1
+            self._buckets.pop(heapq.heappop(heap), None)
+
+        self.reaped += count
+        return count
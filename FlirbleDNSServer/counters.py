@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Query counters
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import threading
+
+
+"""
+A set of named counters, such as the queries for each zone, that can be
+counted from any thread without locking.
+
+Each thread counts into its own shard, a dict indexed by (name, counter),
+which only it changes. stats() adds up the shards. Copying the items of a
+dict is a single step for the interpreter, so the shards can be read while
+their threads carry on counting; a count made at that moment may or may
+not be included, and is picked up by the next call.
+
+The shard of a thread that exits is kept, so its counts are not lost.
+"""
+class Counters(object):
+
+    """The shard of each thread, as a threading.local 'shard'."""
+    _local = None
+
+    """Every shard, and a lock around the list."""
+    _shards = None
+    _lock = None
+
+
+    def __init__(self):
+        super(Counters, self).__init__()
+
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+
+    """
+    Adds to a counter.
+
+    @param name str The thing being counted, such as 'Zone example.com.'.
+    @param counter str The counter for that thing, such as 'queries'.
+    @param n int The amount to add.
+    """
+    def add(self, name, counter, n=1):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+
+        key = (name, counter)
+        shard[key] = shard.get(key, 0) + n
+
+
+    """
+    Returns the counters of all the threads added together.
+
+    @return dict The counters of each name, indexed by name and then
+                counter.
+    """
+    def stats(self):
+        with self._lock:
+            shards = list(self._shards)
+
+        stats = {}
+        for shard in shards:
+            for ((name, counter), n) in shard.items():
+                st = stats.setdefault(name, {})
+                st[counter] = st.get(counter, 0) + n
+        return stats
+
+
+    """
+    Creates the shard of the current thread.
+
+    @return dict The new shard.
+    """
+    def _shard(self):
+        shard = {}
+        self._local.shard = shard
+        with self._lock:
+            self._shards.append(shard)
+        return shard
@@ -21,10 +21,31 @@ import os, logging
 log = logging.getLogger(os.path.basename(__file__))
 
 import sys, threading, time, traceback
-import rethinkdb as r
+
+# RethinkDB is not needed when the data comes from files.
+try:
+    import rethinkdb as r
+except ImportError:
+    r = None
 
 import FlirbleDNSServer as fdns
 
+"""The most changes passed to a table callback at once."""
+FEED_BATCH_SIZE = 1000
+
+"""Seconds to wait for more changes, once there is one to pass on, so that
+   a burst of changes is applied together."""
+FEED_BATCH_DELAY = 0.05
+
+"""Seconds to wait for a change before checking whether we should stop."""
+FEED_IDLE_WAIT = 1.0
+
+"""Seconds to wait before connecting again when a changefeed is lost; each
+   failed attempt doubles the wait, up to FEED_RECONNECT_MAX."""
+FEED_RECONNECT_MIN = 1.0
+FEED_RECONNECT_MAX = 60.0
+
+
 """
 Manages the connection with a RethinkDB.
 
@@ -32,6 +53,13 @@ There is at least one connection to the DB, used to queries and updates.
 Further connections may be initiated and managed from their own threads
 to monitor tables for changes; any such changes are delivered to callback
 functions.
+
+Request only uses start(), register_table() and stop(), so anything with
+those can supply the zones and servers instead; see FileData.
+
+A monitoring thread that loses its connection connects again, waiting a
+little longer after each failure. The table is then loaded again and
+passed to the callback whole, for it to work out what changed meanwhile.
 """
 class Data(object):
     r = None
@@ -40,6 +68,13 @@ class Data(object):
     _tlock = None
     _running = None
 
+    """Counters; see stats()."""
+    reconnects = 0
+    changes = 0
+    batches = 0
+    errors = 0
+    _max_lag = 0.0
+
     """
     Configure the database manager.
 
@@ -55,6 +90,9 @@ class Data(object):
     def __init__(self, remote, name, auth=None, ssl=dict()):
         super(Data, self).__init__()
 
+        if r is None:
+            raise Exception("The rethinkdb module is needed to use RethinkDB.")
+
         if auth is None:
             auth = ""
 
@@ -84,37 +122,42 @@ class Data(object):
     @returns bool True on success, False otherwise.
     """
     def start(self):
+        # Tables can be monitored even if we can't connect now; their
+        # threads keep trying
+        self.running = True
+
         log.info("Connecting to RethinkDB at '%s:%s' db '%s'." %
             (self._host, self._port, self._name))
-        try:
-            self.r = r.connect(host=self._host, port=self._port,
-                db=self._name, auth_key=self._auth, ssl=self._ssl)
-        except r.ReqlDriverError as e:
-            log.error("Unable to connect to RethinkDB at '%s:%s' " \
-                "db '%s': %s." %
-                (self._host, self._port, self._name, e.message))
-            log.debug("%s." % traceback.format_exc())
+        self.r = self._connect()
+        if self.r is None:
             return False
 
-        self.running = True
+        return True
 
 
     """
     Adds a thread monitoring a table for changes, calling the cb when
-    a change is made.
+    changes are made.
+
+    The current contents of the table are passed to the first call of the
+    cb in one go, even if there are none. Later calls pass the changes
+    that arrived together, up to FEED_BATCH_SIZE at a time. If the
+    connection is lost the thread connects again, and the next call
+    passes the current contents of the table again.
 
-    The thread is a daemon thread so it will does not block the process
+    The thread is a daemon thread so it does not block the process
     from exiting.
 
     @param table str The name of the table to monitor.
     @param cb function A function to call when changes arrive. This should
-        match the signature 'def _cb(self, rdb, change)' where 'rdb' is
-        a reference to this calling object and 'change' is a dictionary
-        containing the change. See RethinkDB documentation for the contents
-        of 'chamge'.
+        match the signature 'def _cb(self, rdb, changes, initial)' where
+        'rdb' is a reference to this calling object, 'changes' is a list of
+        dictionaries each containing a change and 'initial' is True if
+        they are the complete contents of the table, so that anything not
+        in them has gone. See RethinkDB documentation for the contents of
+        each change.
     @returns bool True on success, False otherwise. Reasons to fail include
-        failing to connect to the database or trying to monitor a table
-        we're monitoring.
+        trying to monitor a table we're monitoring.
     """
     def register_table(self, table, cb):
         # create _monitor_thread
@@ -122,22 +165,9 @@ class Data(object):
         if table in self._table_threads:
             return False
 
-        log.info("Connecting to RethinkDB at '%s:%s' db '%s' to monitor " \
-            "table '%s'." % (self._host, self._port, self._name, table))
-        try:
-            connection = r.connect(host=self._host, port=self._port,
-                db=self._name, auth_key=self._auth, ssl=self._ssl)
-        except r.ReqlDriverError as e:
-            log.error("Unable to connect to RethinkDB at '%s:%s' " \
-                "db '%s': %s." %
-                (self._host, self._port, self._name, e.message))
-            log.debug("%s." % traceback.format_exc())
-            return False
-
         args = {
             'table': table,
             'cb': cb,
-            'connection': connection
         }
 
         try:
@@ -146,13 +176,12 @@ class Data(object):
             log.error("Unable to start monitoring thread for " \
                 "table '%s': %s." % (table, e.message))
             log.debug("%s." % traceback.format_exc())
-            connection.close()
             return False
 
         with self._tlock:
             self._table_threads[table] = {
                 "thread": t,
-                "connection": connection
+                "connection": None,
             }
 
         t.daemon = True
@@ -162,35 +191,188 @@ class Data(object):
 
 
     """
-    The thread target that monitors a table for changes.
+    Returns a snapshot of the monitoring counters.
+
+    @return dict With these items:
+                * connected The number of tables being monitored.
+                * reconnects The number of times a lost changefeed was
+                    started again.
+                * changes The number of changes received.
+                * batches The number of calls made to the callbacks.
+                * errors The number of those calls that failed.
+                * max_lag_ms The longest time, since the last call to this,
+                    from a change arriving to it being applied.
+    """
+    def stats(self):
+        with self._tlock:
+            connected = len([tt for tt in self._table_threads.values()
+                if tt['connection'] is not None])
+            (lag, self._max_lag) = (self._max_lag, 0.0)
+            return {
+                'connected': connected,
+                'reconnects': self.reconnects,
+                'changes': self.changes,
+                'batches': self.batches,
+                'errors': self.errors,
+                'max_lag_ms': int(lag * 1000),
+            }
+
 
-    @param table str The name of the table to monitor.
-    @param cb function The callback function that will be called.
-    @param connection rethinkdb.Connection The database connection to use
-        for the monitoring.
     """
-    def _monitor_thread(self, table, cb, connection):
-        log.info("Monitoring table '%s' for changes." % table)
-        feed = r.table(table).changes(include_initial=True).run(connection)
+    Opens a connection to the database.
+
+    @return rethinkdb.Connection The connection, or None on failure.
+    """
+    def _connect(self):
+        try:
+            return r.connect(host=self._host, port=self._port,
+                db=self._name, auth_key=self._auth, ssl=self._ssl)
+        except r.ReqlDriverError as e:
+            log.error("Unable to connect to RethinkDB at '%s:%s' " \
+                "db '%s': %s." %
+                (self._host, self._port, self._name, e.message))
+            log.debug("%s." % traceback.format_exc())
+            return None
 
-        # TODO need to find a way to make this interruptible for a cleaner
-        # exit when we're asked to stop running
-        for change in feed:
-            cb(self, change)
 
-            if not self.running:
-                break
+    """
+    The thread target that monitors a table for changes, connecting again
+    whenever the connection is lost.
+
+    @param table str The name of the table to monitor.
+    @param cb function The callback function that will be called.
+    """
+    def _monitor_thread(self, table, cb):
+        delay = FEED_RECONNECT_MIN
+        first = True
+        while self.running:
+            if not first:
+                # Wait a while, but not past being asked to stop
+                log.info("Reconnecting to monitor table '%s' in %.0f " \
+                    "seconds." % (table, delay))
+                until = time.time() + delay
+                while self.running and time.time() < until:
+                    time.sleep(min(FEED_IDLE_WAIT, until - time.time()))
+                if not self.running:
+                    break
+                delay = min(delay * 2, FEED_RECONNECT_MAX)
+                with self._tlock:
+                    self.reconnects += 1
+            first = False
+
+            log.info("Connecting to RethinkDB at '%s:%s' db '%s' to " \
+                "monitor table '%s'." %
+                (self._host, self._port, self._name, table))
+            connection = self._connect()
+            if connection is None:
+                continue
+
+            with self._tlock:
+                self._table_threads[table]['connection'] = connection
+
+            try:
+                if self._follow(table, cb, connection):
+                    # It was working for a while, so start backing off
+                    # from the beginning again
+                    delay = FEED_RECONNECT_MIN
+            except r.ReqlError as e:
+                log.error("Lost the changefeed for table '%s': %s." %
+                    (table, e.message))
+            except Exception:
+                log.error("Lost the changefeed for table '%s': %s" %
+                    (table, traceback.format_exc()))
+            finally:
+                with self._tlock:
+                    self._table_threads[table]['connection'] = None
+                try:
+                    connection.close()
+                except:
+                    pass
 
         log.info("Closing RethinkDB connection for " \
             "monitoring table '%s'." % table)
 
         with self._tlock:
-            del(self._table_threads[table])
+            self._table_threads.pop(table, None)
 
-        try:
-            connection.close()
-        except:
-            pass
+
+    """
+    Follows the changefeed of a table, passing changes on to the callback,
+    until asked to stop or the feed fails.
+
+    @param table str The name of the table to monitor.
+    @param cb function The callback function that will be called.
+    @param connection rethinkdb.Connection The database connection to use
+        for the monitoring.
+    @return bool True if the table was loaded before the feed ended.
+    """
+    def _follow(self, table, cb, connection):
+        log.info("Monitoring table '%s' for changes." % table)
+        feed = r.table(table).changes(include_initial=True,
+            include_states=True).run(connection)
+
+        ready = False
+        initial = True
+        batch = []
+        received = None
+        while self.running:
+            # Until the table is loaded gather all of it; after that, wait
+            # only a moment for more once we have something to pass on
+            if not ready:
+                wait = FEED_IDLE_WAIT
+            elif len(batch):
+                wait = FEED_BATCH_DELAY
+            else:
+                wait = FEED_IDLE_WAIT
+
+            try:
+                change = feed.next(wait=wait)
+            except r.ReqlTimeoutError:
+                change = None
+            except (r.ReqlCursorEmpty, StopIteration):
+                log.error("The changefeed for table '%s' ended." % table)
+                break
+
+            if change is None:
+                # Nothing more has arrived; pass on what we have
+                if not ready or len(batch) == 0:
+                    continue
+            elif 'state' in change:
+                if change['state'] != 'ready' or ready:
+                    continue
+                ready = True
+                log.info("Loaded %d rows from table '%s'." %
+                    (len(batch), table))
+            else:
+                if received is None:
+                    received = time.time()
+                batch.append(change)
+                if not ready or len(batch) < FEED_BATCH_SIZE:
+                    continue
+
+            # A batch we can't apply must not stop us seeing the rest
+            failed = False
+            try:
+                cb(self, batch, initial)
+            except Exception:
+                log.error("Unable to apply %d changes to table '%s': %s" %
+                    (len(batch), table, traceback.format_exc()))
+                failed = True
+
+            with self._tlock:
+                self.changes += len(batch)
+                self.batches += 1
+                if failed:
+                    self.errors += 1
+                if received is not None:
+                    self._max_lag = max(self._max_lag,
+                        time.time() - received)
+
+            initial = False
+            batch = []
+            received = None
+
+        return ready
 
 
     """
@@ -201,15 +383,19 @@ class Data(object):
         log.info("Shutting down table monitoring threads...")
         self.running = False
 
-        for table in self._table_threads:
-            tt = self._table_threads[table]
+        # The threads remove themselves as they stop
+        with self._tlock:
+            threads = list(self._table_threads.items())
+
+        for (table, tt) in threads:
             log.debug("Waiting for thread monitoring " \
                 "table '%s' to stop..." % table)
             tt['thread'].join(1)
 
         log.info("Closing main RethinkDB connection...")
-        self.r.close()
+        if self.r is not None:
+            self.r.close()
 
-        # Cleanup
-        self._table_threads = {}
+        # Cleanup; any thread still waiting on its feed removes itself
+        # from self._table_threads when it gets to stop
         self.r = None
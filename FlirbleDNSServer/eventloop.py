@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Single threaded event loop engine
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import sys, time, datetime, socket, select, errno, struct, threading
+import traceback
+
+import FlirbleDNSServer as fdns
+
+"""Maximum number of UDP datagrams to process per readable event, so that
+   a busy UDP socket can not starve the TCP connections."""
+UDP_BATCH = 64
+
+"""Number of bytes to attempt to receive at a time on a TCP connection."""
+TCP_RECV_SIZE = 8192
+
+"""Socket errors that just mean 'try again later'."""
+_EAGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+"""
+The state of one TCP client connection.
+"""
+class _Connection(object):
+
+    """The connected socket."""
+    sock = None
+
+    """The file descriptor of the socket, kept so that it is still known
+    once the socket is closed."""
+    fd = None
+
+    """The client address tuple."""
+    address = None
+
+    """Bytes received but not yet assembled into a complete message."""
+    rbuf = None
+
+    """Bytes waiting to be sent."""
+    wbuf = None
+
+    """The time of the last activity on the connection."""
+    last = None
+
+    def __init__(self, sock, address):
+        super(_Connection, self).__init__()
+
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.last = time.time()
+
+
+"""
+A DNS server that serves both UDP and TCP from a single thread using
+non-blocking sockets and poll().
+
+UDP datagrams are answered as they are read. TCP connections are kept open
+and may carry several, possibly pipelined, queries; each complete message
+in the receive buffer is answered in turn and the replies are written as
+the socket allows. Once TCP_MAX_PENDING bytes of replies are waiting on a
+connection no more queries are read from it until the client has read
+some. Idle TCP connections are closed after TCP_IDLE_TIMEOUT seconds, and
+no more than TCP_MAX_CONNECTIONS are kept open; these are shared with
+TCPRequestHandler.
+
+Answers are produced by the same Request.handler() as the threaded
+servers. This provides the same serve_forever(), shutdown() and stats()
+methods as the SocketServer based services so that Server can run either.
+"""
+class EventLoopServer(object):
+
+    """The DNS handler that will handle requests."""
+    response = None
+
+    """The bound UDP socket."""
+    udp = None
+
+    """The listening TCP socket."""
+    tcp = None
+
+    """Open TCP connections, indexed by file descriptor."""
+    connections = None
+
+    """The poll object."""
+    _poll = None
+
+    """Whether serve_forever() should keep running."""
+    _running = False
+
+    """Set when serve_forever() has exited."""
+    _stopped = None
+
+    """Counters; see stats()."""
+    _counters = None
+
+
+    """
+    Creates and binds the UDP and TCP sockets.
+
+    @param server_address list A tuple of (ip_address, protocol_port) that
+                indicates the local bound endpoint address and port.
+    @param response Request The DNS processor that will interpret requests
+                presented to this server.
+    @param reuse_port bool Set SO_REUSEPORT on the sockets so that several
+                processes can bind the same address and port.
+    """
+    def __init__(self, server_address, response=None, reuse_port=False):
+        super(EventLoopServer, self).__init__()
+
+        if response is not None:
+            self.response = response
+
+        self.connections = {}
+        self._stopped = threading.Event()
+        self._counters = {
+            'udp': 0,
+            'tcp': 0,
+            'accepted': 0,
+            'refused': 0,
+            'timeouts': 0,
+            'errors': 0,
+        }
+
+        self.udp = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            fdns.set_reuse_port(self.udp)
+        self.udp.bind(server_address)
+        self.udp.setblocking(0)
+
+        self.tcp = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            fdns.set_reuse_port(self.tcp)
+        self.tcp.bind(server_address)
+        self.tcp.listen(socket.SOMAXCONN)
+        self.tcp.setblocking(0)
+
+        self.server_address = self.udp.getsockname()
+
+
+    """
+    Runs the event loop until shutdown() is called.
+
+    @param poll_interval float How often, in seconds, to check for
+                shutdown and idle connections.
+    """
+    def serve_forever(self, poll_interval=0.5):
+        self._poll = select.poll()
+        self._poll.register(self.udp.fileno(), select.POLLIN)
+        self._poll.register(self.tcp.fileno(), select.POLLIN)
+
+        self._running = True
+        self._stopped.clear()
+        next_sweep = time.time() + poll_interval
+
+        try:
+            while self._running:
+                try:
+                    events = self._poll.poll(poll_interval * 1000)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for (fd, event) in events:
+                    if fd == self.udp.fileno():
+                        self._udp_read()
+                    elif fd == self.tcp.fileno():
+                        self._tcp_accept()
+                    elif fd in self.connections:
+                        self._tcp_event(self.connections[fd], event)
+
+                now = time.time()
+                if now >= next_sweep:
+                    self._sweep(now)
+                    next_sweep = now + poll_interval
+        finally:
+            for conn in self.connections.values():
+                self._close(conn)
+            self._poll = None
+            self._stopped.set()
+
+
+    """
+    Stops the event loop and closes the sockets. Waits for serve_forever()
+    to exit.
+    """
+    def shutdown(self):
+        self._running = False
+        self._stopped.wait(5)
+        self.udp.close()
+        self.tcp.close()
+
+
+    """
+    Returns a snapshot of the engine counters.
+
+    @return dict With these items:
+                * udp The number of UDP queries answered.
+                * tcp The number of TCP queries answered.
+                * connections The number of TCP connections open now.
+                * accepted The number of TCP connections accepted.
+                * refused The number of TCP connections closed because too
+                    many were open.
+                * timeouts The number of TCP connections closed for
+                    being idle.
+                * errors The number of queries that raised an exception.
+    """
+    def stats(self):
+        stats = dict(self._counters)
+        stats['connections'] = len(self.connections)
+        return stats
+
+
+    """
+    Passes a raw DNS message to the response handler.
+
+    @param proto str The transport name, for diagnostics.
+    @param data str A raw, complete DNS packet.
+    @param address tuple The client address.
+    @return str The raw DNS reply, or None on error.
+    """
+    def _answer(self, proto, data, address):
+        if fdns.debug:
+            now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+            log.debug("%s request %s (%s %s):" % (proto, now,
+                address[0], address[1]))
+        if self.response is None:
+            return None
+        try:
+            return self.response.handler(data, address)
+        except Exception:
+            self._counters['errors'] += 1
+            log.error("Exception handling data: %s" % traceback.format_exc())
+            return None
+
+
+    """
+    Reads and answers waiting UDP datagrams.
+    """
+    def _udp_read(self):
+        for i in range(UDP_BATCH):
+            try:
+                (data, address) = self.udp.recvfrom(65535)
+            except socket.error as e:
+                if e.args[0] in _EAGAIN:
+                    return
+                raise
+
+            reply = self._answer('UDP', data, address)
+            if reply is None:
+                continue
+
+            self._counters['udp'] += 1
+            try:
+                self.udp.sendto(reply, address)
+            except socket.error as e:
+                # A full send buffer just means this reply is lost, as it
+                # may be anywhere else on the path.
+                if e.args[0] not in _EAGAIN:
+                    log.error("Error sending UDP reply to %s: %s" %
+                        (address[0], e))
+
+
+    """
+    Accepts waiting TCP connections.
+    """
+    def _tcp_accept(self):
+        while True:
+            try:
+                (sock, address) = self.tcp.accept()
+            except socket.error as e:
+                if e.args[0] in _EAGAIN or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+
+            if len(self.connections) >= fdns.TCP_MAX_CONNECTIONS:
+                sock.close()
+                self._counters['refused'] += 1
+                continue
+
+            sock.setblocking(0)
+            conn = _Connection(sock, address)
+            self.connections[conn.fd] = conn
+            self._poll.register(conn.fd, select.POLLIN)
+            self._counters['accepted'] += 1
+
+
+    """
+    Handles a poll event on a TCP connection.
+
+    @param conn _Connection The connection.
+    @param event int The poll event mask.
+    """
+    def _tcp_event(self, conn, event):
+        if event & (select.POLLERR | select.POLLNVAL):
+            self._close(conn)
+            return
+
+        if event & (select.POLLIN | select.POLLHUP):
+            try:
+                data = conn.sock.recv(TCP_RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] in _EAGAIN:
+                    return
+                self._close(conn)
+                return
+
+            if len(data) == 0:
+                # Peer closed its side; drop anything we had left to send.
+                self._close(conn)
+                return
+
+            conn.last = time.time()
+            conn.rbuf += data
+            self._tcp_process(conn)
+
+            # Writing the replies may have failed and closed it
+            if self.connections.get(conn.fd) is not conn:
+                return
+
+        if event & select.POLLOUT:
+            self._tcp_write(conn)
+
+            # Answer what was held back while the replies backed up
+            if self.connections.get(conn.fd) is conn and len(conn.rbuf) and \
+                    len(conn.wbuf) < fdns.TCP_MAX_PENDING:
+                self._tcp_process(conn)
+
+
+    """
+    Answers each complete message in the receive buffer of a connection,
+    until TCP_MAX_PENDING bytes of replies are waiting to be sent.
+
+    @param conn _Connection The connection.
+    """
+    def _tcp_process(self, conn):
+        while len(conn.rbuf) >= 2 and \
+                len(conn.wbuf) < fdns.TCP_MAX_PENDING:
+            (sz,) = struct.unpack('!H', bytes(conn.rbuf[:2]))
+            if len(conn.rbuf) < sz + 2:
+                break
+
+            data = bytes(conn.rbuf[2:sz + 2])
+            del conn.rbuf[:sz + 2]
+
+            reply = self._answer('TCP', data, conn.address)
+            if reply is None:
+                continue
+
+            self._counters['tcp'] += 1
+            conn.wbuf += struct.pack('!H', len(reply))
+            conn.wbuf += reply
+
+        self._tcp_write(conn)
+
+
+    """
+    Writes as much of the send buffer of a connection as the socket will
+    take, and asks to be told when it can take more. While the buffer
+    holds TCP_MAX_PENDING bytes or more, nothing more is read from the
+    connection; if the client reads nothing either, the connection goes
+    idle and is closed.
+
+    @param conn _Connection The connection.
+    """
+    def _tcp_write(self, conn):
+        if len(conn.wbuf):
+            try:
+                sent = conn.sock.send(conn.wbuf)
+                del conn.wbuf[:sent]
+                if sent:
+                    conn.last = time.time()
+            except socket.error as e:
+                if e.args[0] not in _EAGAIN:
+                    self._close(conn)
+                    return
+
+        mask = 0
+        if len(conn.wbuf) < fdns.TCP_MAX_PENDING:
+            mask |= select.POLLIN
+        if len(conn.wbuf):
+            mask |= select.POLLOUT
+        self._poll.modify(conn.fd, mask)
+
+
+    """
+    Closes TCP connections that have been idle for too long.
+
+    @param now float The current time.
+    """
+    def _sweep(self, now):
+        for conn in self.connections.values():
+            if now - conn.last > fdns.TCP_IDLE_TIMEOUT:
+                self._counters['timeouts'] += 1
+                self._close(conn)
+
+
+    """
+    Closes a TCP connection and forgets about it.
+
+    @param conn _Connection The connection.
+    """
+    def _close(self, conn):
+        # Once closed, the fd may have been reused by another connection
+        fd = conn.fd
+        if self.connections.get(fd) is conn:
+            del(self.connections[fd])
+            try:
+                if self._poll is not None:
+                    self._poll.unregister(fd)
+            except (KeyError, ValueError, select.error):
+                pass
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# JSON file data source
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import threading, json, traceback
+
+import FlirbleDNSServer as fdns
+
+"""Seconds between checks of the files for changes."""
+FILE_POLL_INTERVAL = 1.0
+
+
+"""
+A source of zone and server data read from JSON files, in the same form
+as zones.json and servers.json, instead of RethinkDB.
+
+This can be used wherever a Data object is: each table is a file, and
+register_table() passes its contents to the callback in the same form as
+a changefeed would. The files are checked for changes every
+FILE_POLL_INTERVAL seconds by a single thread. When a file has changed it
+is read again and compared with what was read before, and the records
+that were added, changed or removed are passed to the callback together,
+so they are applied all at once. A file that can not be read or parsed,
+perhaps because it is still being written, is tried again once it changes.
+"""
+class FileData(object):
+
+    """The directory holding the files."""
+    directory = None
+
+    """The state of each table, indexed by table name: the file, its
+    callback, the stat() of the file when last read, and the records read
+    from it, indexed by name."""
+    _tables = None
+
+    """A lock around self._tables."""
+    _tlock = None
+
+    """Serializes reading the files, so that each change is passed on
+    once."""
+    _rlock = None
+
+    """The polling thread."""
+    _thread = None
+
+    """Counters; see stats()."""
+    reloads = 0
+    errors = 0
+
+    """Set when asked to stop."""
+    _stopping = None
+
+
+    """
+    @param directory str The directory holding the files. The file for a
+                table is named after it with '.json' added, unless it
+                already ends with '.json'.
+    """
+    def __init__(self, directory):
+        super(FileData, self).__init__()
+
+        self.directory = directory
+        self._tables = {}
+        self._tlock = threading.Lock()
+        self._rlock = threading.Lock()
+        self._stopping = threading.Event()
+
+
+    """
+    Checks the directory exists. The thread that watches the files is
+    started by the first register_table(), so that it survives the process
+    daemonizing in between.
+
+    @returns bool True on success, False otherwise.
+    """
+    def start(self):
+        if not os.path.isdir(self.directory):
+            log.error("Data directory '%s' does not exist." %
+                self.directory)
+            return False
+
+        log.info("Reading zone and server data from '%s'." % self.directory)
+        return True
+
+
+    """
+    Reads a table from its file, calling the cb with its contents now and
+    with any changes to it later. See Data.register_table().
+
+    @param table str The name of the table.
+    @param cb function The function to call with changes, with the
+        signature 'def _cb(self, rdb, changes, initial)'.
+    @returns bool True on success, False otherwise. Reasons to fail include
+        trying to read a table we're already reading.
+    """
+    def register_table(self, table, cb):
+        with self._tlock:
+            if table in self._tables:
+                return False
+
+            filename = table
+            if not filename.endswith('.json'):
+                filename += '.json'
+
+            self._tables[table] = {
+                'path': os.path.join(self.directory, filename),
+                'cb': cb,
+                'stat': None,
+                'rows': None,
+            }
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll_thread,
+                    name='FileData')
+                self._thread.daemon = True
+                self._thread.start()
+
+        # The first read gives the contents of the table straight away,
+        # much as a changefeed would
+        self._check(table)
+        return True
+
+
+    """
+    Returns a snapshot of the counters.
+
+    @return dict With these items:
+                * reloads The number of times a file was read.
+                * errors The number of files that could not be read or
+                    applied.
+    """
+    def stats(self):
+        return {
+            'reloads': self.reloads,
+            'errors': self.errors,
+        }
+
+
+    """
+    Stops watching the files.
+    """
+    def stop(self):
+        log.info("Shutting down data file monitoring...")
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+
+
+    """
+    The body of the thread that watches the files.
+    """
+    def _poll_thread(self):
+        while not self._stopping.wait(fdns.FILE_POLL_INTERVAL):
+            with self._tlock:
+                tables = list(self._tables.keys())
+            for table in tables:
+                self._check(table)
+
+
+    """
+    Reads the file of a table if it has changed, and passes the changes to
+    the callback of the table.
+
+    @param table str The name of the table.
+    """
+    def _check(self, table):
+        with self._rlock:
+            self._read(table)
+
+
+    """
+    The body of _check(). self._rlock must be held.
+    """
+    def _read(self, table):
+        t = self._tables[table]
+        try:
+            st = os.stat(t['path'])
+        except OSError as e:
+            if t['stat'] != 'missing':
+                log.error("Unable to read data file '%s': %s" %
+                    (t['path'], e))
+                t['stat'] = 'missing'
+            return
+
+        stat = (st.st_ino, st.st_size, st.st_mtime)
+        if stat == t['stat']:
+            return
+        t['stat'] = stat
+
+        try:
+            with open(t['path'], 'r') as f:
+                records = json.load(f)
+            rows = dict([(record['name'], record) for record in records])
+        except Exception as e:
+            log.error("Unable to load data file '%s': %s" % (t['path'], e))
+            self.errors += 1
+            return
+        self.reloads += 1
+
+        # Work out what changed since the last time
+        old = t['rows']
+        changes = []
+        if old is None:
+            changes = [{'new_val': row} for row in rows.values()]
+        else:
+            for (name, row) in rows.items():
+                if old.get(name) != row:
+                    changes.append({'old_val': old.get(name), 'new_val': row})
+            for (name, row) in old.items():
+                if name not in rows:
+                    changes.append({'old_val': row, 'new_val': None})
+
+        if old is None:
+            log.info("Loaded %d rows for table '%s' from '%s'." %
+                (len(rows), table, t['path']))
+        elif len(changes):
+            log.info("Loaded %d changes to table '%s' from '%s'." %
+                (len(changes), table, t['path']))
+
+        t['rows'] = rows
+        if old is None or len(changes):
+            # Changes we can't apply must not stop us seeing later ones
+            try:
+                t['cb'](self, changes, old is None)
+            except Exception:
+                log.error("Unable to apply %d changes to table '%s': %s" %
+                    (len(changes), table, traceback.format_exc()))
+                self.errors += 1
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Immutable data structures
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+
+"""
+A dict that can not be modified once created.
+
+This is a real dict so lookups cost the same as on a normal dict and it
+can be passed to anything that expects one, such as json.dumps(). Any
+attempt to change it raises TypeError.
+"""
+class FrozenDict(dict):
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object does not support item assignment" %
+            self.__class__.__name__)
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    """
+    Allows copying and pickling, which would otherwise try to fill in a
+    new, empty, object item by item.
+    """
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, dict.__repr__(self))
+
+
+"""
+Returns an immutable copy of a structure decoded from JSON: dicts become
+FrozenDicts and lists become tuples, recursively. Anything else is returned
+as-is.
+
+Readers can hold a reference to a frozen structure without a lock, and
+without copying it, since nobody can change it underneath them; writers
+build a new structure and swap the reference instead.
+
+@param value object The structure to freeze.
+@return object The frozen structure.
+"""
+def freeze(value):
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict([(k, freeze(v)) for (k, v) in value.items()])
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(v) for v in value])
+    return value
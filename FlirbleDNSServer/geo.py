@@ -21,49 +21,260 @@
 import os, logging
 log = logging.getLogger(os.path.basename(__file__))
 
-import sys, time
-import threading
-import geoip2.database
+import sys, time, math, array, heapq
+import threading, socket
+import maxminddb
+
+# NumPy is optional; without it candidates are ranked in a Python loop.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import FlirbleDNSServer as fdns
 
+"""
+How the GeoIP database can be opened:
+
+* 'mmap' maps the file into memory. Each thread has its own reader, and the
+  readers share the same pages.
+* 'memory' reads the whole file into memory once. All threads share that one
+  reader, since each reader holds its own copy.
+* 'auto' uses the C extension if it is installed and 'mmap' otherwise.
+"""
+GEODB_MODES = {
+    'mmap': maxminddb.MODE_MMAP,
+    'memory': maxminddb.MODE_MEMORY,
+    'auto': maxminddb.MODE_AUTO,
+}
+
+"""Default way to open the GeoIP database."""
+GEODB_MODE = 'mmap'
+
+
+"""
+Returns the network an address is in, as a string.
+
+@param client str The IPv4 or IPv6 address.
+@param v4_len int The prefix length to use for an IPv4 address.
+@param v6_len int The prefix length to use for an IPv6 address.
+@return str The network, such as "192.0.2.0/24", or None if the address
+            can not be parsed.
+"""
+def client_network(client, v4_len, v6_len):
+    if ':' in client:
+        (family, bits, length) = (socket.AF_INET6, 128, v6_len)
+    else:
+        (family, bits, length) = (socket.AF_INET, 32, v4_len)
+    try:
+        packed = socket.inet_pton(family, client)
+    except socket.error:
+        return None
+
+    length = max(0, min(bits, int(length)))
+    value = int(packed.encode('hex'), 16)
+    value &= ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+    packed = ('%0*x' % (bits // 4, value)).decode('hex')
+    return "%s/%d" % (socket.inet_ntop(family, packed), length)
+
+
+"""
+A set of candidate servers with their coordinates and status held in
+arrays, so that a client can be compared against all of them in one pass.
+
+These are built when the server data changes rather than for each query.
+Values missing from a server record, such as 'load' on a server that does
+not report it, are held as NaN, which never passes a comparison and so
+never filters the server out.
+"""
+class CandidateSet(object):
+
+    """The server records, in order."""
+    servers = None
+
+    """The latitude and longitude of each server, in radians, and the
+    cosine of the latitude; see prepare_point()."""
+    lat = None
+    lon = None
+    coslat = None
+
+    """The unit vector of each server's coordinates; see prepare_point()."""
+    x = None
+    y = None
+    z = None
+
+    """All of the above for each server, as one tuple per server, for
+    the distance functions in PREPARED_DISTANCE."""
+    points = None
+
+    """The reported load of each server."""
+    load = None
+
+    """The timestamp of the last update from each server."""
+    ts = None
+
+    """The GeoGrid for these servers, once one has been built."""
+    grid = None
+
+    """The SpatialIndex of each group the servers are from, or None if
+    the servers are not to be ranked with them."""
+    indexes = None
+
+    """The position of each server, indexed by the 'name' in its record."""
+    position = None
+
+
+    """
+    @param servers list The server records. Each should provide their lat
+                and lon coordinates.
+    """
+    def __init__(self, servers):
+        super(CandidateSet, self).__init__()
+
+        self.servers = tuple(servers)
+
+        nan = float('nan')
+        points = []
+        (load, ts) = ([], [])
+        for server in self.servers:
+            if 'lat' in server and 'lon' in server:
+                p = fdns.prepare_point(float(server['lat']),
+                    float(server['lon']))
+            else:
+                p = (nan,) * 6
+            points.append(p)
+            load.append(float(server['load']) if 'load' in server else nan)
+            ts.append(float(server['ts']) if 'ts' in server else nan)
+
+        if numpy is not None:
+            make = lambda values: numpy.array(values, dtype=float)
+        else:
+            make = lambda values: array.array('d', values)
+
+        (self.lat, self.lon, self.coslat, self.x, self.y, self.z) = \
+            [make([p[i] for p in points]) for i in range(6)]
+        self.load = make(load)
+        self.ts = make(ts)
+        self.points = tuple(points)
+        self.position = dict([(server.get('name'), i)
+            for (i, server) in enumerate(self.servers)])
+
+
+    def __len__(self):
+        return len(self.servers)
+
+
+    def __iter__(self):
+        return iter(self.servers)
+
+
 """
 Handles Geographic lookup and related operations.
 
-This class uses a lock to serialize all database operations in order to
-ensure threadsafe operation.
+Lookups do not take a lock. Each thread that does a lookup opens its own
+reader on the database, in the mode given by GEODB_MODE, so that lookups
+in different threads run in parallel. Worker processes each create their
+own Geo, and so their own readers, after they are forked.
 """
 class Geo(object):
 
+    """The path to the database."""
     geodb_file = None
+
+    """The name of the mode the database is opened in; see GEODB_MODES."""
+    mode = None
+
+    """The current shared reader. Thread readers are opened alongside it."""
     geodb = None
 
+    """Incremented each time the database is reopened, so that threads know
+    to replace their readers."""
+    generation = 0
+
+    """Serializes reopen(); lookups do not use it."""
     lock = None
 
+    """The reader of each thread, and the generation it was opened at."""
+    _local = None
+
     """
     @param geodb str The path to a Maxmind GeoIP2 Cities database. This must
                 exist at instantiation otherwise this class will not function.
+    @param mode str How to open the database, one of GEODB_MODES. Default is
+                GEODB_MODE.
     """
-    def __init__(self, geodb=None):
+    def __init__(self, geodb=None, mode=None):
         super(Geo, self).__init__()
 
         self.lock = threading.Lock()
+        self._local = threading.local()
+        self.mode = mode if mode is not None else fdns.GEODB_MODE
 
         if geodb is not None:
             self.geodb_file = geodb
-            with self.lock:
-                self.geodb = geoip2.database.Reader(geodb)
+            self.geodb = self._open()
 
 
     """
-    Closes and reopens the Maxmind GeoIP2 database. Typically this is
-    performed to access a newer version of the database. If reopening the
-    database fails this class is rendered inoperable.
+    Reopens the Maxmind GeoIP2 database. Typically this is performed to
+    access a newer version of the database.
+
+    The new reader is opened before the current one is replaced, so a
+    failure leaves the current one in place, and queries are not held up
+    while the file is opened. Lookups already in progress finish with the
+    reader they started with; each thread picks up a new reader on its
+    next lookup and closes its old one. Readers that are no longer used by
+    any thread are released once the last lookup using them is done.
     """
     def reopen(self):
         with self.lock:
-            self.geodb.close()
-            self.geodb = geoip2.database.Reader(self.geodb_file)
+            geodb = self._open()
+            self.geodb = geodb
+            self.generation += 1
+
+
+    """
+    Opens a new reader on the database. This uses the maxminddb reader
+    that geoip2 is built on directly, since it can also tell us which
+    network an address is in and it skips building a model object for each
+    lookup.
+
+    @return maxminddb.reader.Reader The reader.
+    """
+    def _open(self):
+        return maxminddb.open_database(self.geodb_file, GEODB_MODES[self.mode])
+
+
+    """
+    Returns the reader the calling thread should use for a lookup, opening
+    one if the thread does not have a current one.
+
+    @return maxminddb.reader.Reader The reader, or None if there is no
+                database.
+    """
+    def _reader(self):
+        geodb = self.geodb
+        if geodb is None or self.geodb_file is None or self.mode == 'memory':
+            return geodb
+
+        local = self._local
+        generation = self.generation
+        reader = getattr(local, 'reader', None)
+        if reader is not None and local.generation == generation:
+            return reader
+
+        if reader is not None:
+            reader.close()
+            local.reader = None
+        try:
+            local.reader = self._open()
+        except Exception as e:
+            # Carry on with the shared reader; try again next time.
+            log.error("Can't open GeoIP database '%s': %s" %
+                (self.geodb_file, e))
+            return geodb
+        local.generation = generation
+        return local.reader
 
 
     """
@@ -91,8 +302,13 @@ class Geo(object):
     same server, or subset of servers, in subsequent queries. This is
     probably considered a desirable trait.
 
-    @param servers hash A set of candidate servers. Each should provide
-                their lat and lon coordinates.
+    This is locate(), rank() and select() in turn; callers that cache the
+    ranking can call them separately.
+
+    @param servers CandidateSet|list A set of candidate servers. Each
+                should provide their lat and lon coordinates. A list is
+                converted to a CandidateSet first; callers that query the
+                same set repeatedly should build and keep one.
     @param client str The IPv4 or IPv6 address of the client on which a GeoIP
                 lookup will be performed.
     @param params hash A set of optional parameters used to influence the
@@ -105,89 +321,132 @@ class Geo(object):
                     to the nearest 50. The default is 50.
                 * maxreplies Sets the number of servers to include in a reply.
                     The default is 1.
+                * distance How distances are calculated, one of
+                    GCS_DISTANCE_MODES. The default is set by
+                    GCS_DISTANCE_MODE.
+    @param rejected dict If given, the number of candidates left out for
+                each reason is added to it; see rank().
     """
-    def find_closest_server(self, servers, client, params=None):
+    def find_closest_server(self, servers, client, params=None,
+            rejected=None):
         if params is None:
             params = {}
 
-        if self.geodb is None:
+        location = self.locate(client)
+        if location is None or location is False:
+            return location
+
+        return self.select(self.rank(servers, location, params, rejected),
+            client, params)
+
+
+    """
+    Looks up the location of a client.
+
+    @param client str The IPv4 or IPv6 address of the client.
+    @return list A tuple of (lat, lon, network) where network is the
+                network the database holds the location for, such as
+                "192.0.2.0/24", or None if the reader does not say. Returns
+                False if the address has no location, or None if there is no
+                database.
+    """
+    def locate(self, client):
+        geodb = self._reader()
+        if geodb is None:
             return None
 
         # Lookup the client address
         try:
-            with self.lock:
-                city = self.geodb.city(client)
+            if hasattr(geodb, 'get_with_prefix_len'):
+                (record, prefix_len) = geodb.get_with_prefix_len(client)
+            else:
+                (record, prefix_len) = (geodb.get(client), None)
+            location = record['location']
+            lat = float(location['latitude'])
+            lon = float(location['longitude'])
         except:
             log.error("Can't do city lookup on '%s'" % client)
             return False
 
-        lat = city.location.latitude
-        lon = city.location.longitude
-
-        # The shortest distance discovered
-        mindist = sys.maxsize
-        # List of servers found at the shortest distance
-        ranked = []
+        network = None
+        if prefix_len is not None:
+            network = client_network(client, prefix_len, prefix_len)
+        return (lat, lon, network)
 
-        for server in servers:
-            # check server load, if applicable
-            # if the server reports a negative value for load then consider
-            # it unavailable
-            if 'load' in server:
-                if float(server['load']) < 0.0:
-                    continue
-
-                # now compare it with any maxload we're given by the zone.
-                # if the reported load is higher, it's not a candidate
-                if 'maxload' in params:
-                    if float(server['load']) > float(params['maxload']):
-                        # server load exceeds allowable maximum, don't
-                        # consider it as a candidate
-                        continue
 
+    """
+    Ranks the candidates by their distance from a location. This depends
+    only on the location, not the client, so the result can be shared by
+    all the clients at the location.
+
+    @param servers CandidateSet|list A set of candidate servers; see
+                find_closest_server().
+    @param location list A tuple of (lat, lon, ...) as from locate().
+    @param params hash The selection parameters; see find_closest_server().
+    @param rejected dict If given, the number of candidates left out for
+                each reason is added to it, indexed by the reason: 'load'
+                for being unavailable or over maxload, 'maxage' or
+                'maxdist'. Only the servers looked at are counted, which
+                with a grid or spatial indexes is those near the location.
+    @return list The server records found at the shortest distance, in
+                their original order, or False if there are none.
+    """
+    def rank(self, servers, location, params, rejected=None):
+        if not isinstance(servers, CandidateSet):
+            servers = CandidateSet(servers)
+
+        # use default precision unless one is given in the parameters
+        precision = float(params.get('precision',
+            fdns.GCS_DISTANCE_PRECISION))
+
+        # a negative value (or the value is not present) means no limit
+        maxload = float(params['maxload']) if 'maxload' in params else None
+        maxage = float(params['maxage']) if 'maxage' in params else None
+        maxdist = float(params['maxdist']) if 'maxdist' in params else -1.0
+
+        mode = params.get('distance', fdns.GCS_DISTANCE_MODE)
+        if mode not in fdns.GCS_DISTANCE_MODES:
+            log.error("Unknown distance mode '%s'; using '%s'." %
+                (mode, fdns.GCS_DISTANCE_MODE))
+            mode = fdns.GCS_DISTANCE_MODE
+
+        ranked = None
+        grid = servers.grid
+        if grid is not None and mode != 'equirectangular':
+            ranked = self._rank_grid(servers, grid, location[:2], mode,
+                precision, maxload, maxage, maxdist, rejected)
+
+        if ranked is None and servers.indexes is not None and \
+                mode != 'equirectangular':
+            ranked = self._rank_index(servers, location[:2], mode,
+                precision, maxload, maxage, maxdist, rejected)
+
+        if ranked is not None:
+            pass
+        elif numpy is not None:
+            ranked = self._rank_numpy(servers, location[:2], mode, precision,
+                maxload, maxage, maxdist, rejected)
+        else:
+            ranked = self._rank_python(servers, location[:2], mode,
+                precision, maxload, maxage, maxdist, rejected)
+
+        # Nothing found?
+        if len(ranked) == 0:
+            return False
+        return ranked
 
-            # check the timestamp of when we received the last update
-            # if it's too old, the server's not a candidate since it's not
-            # keeping us informed (and therefore probably dead)
-            if 'maxage' in params and 'ts' in server:
-                ts = float(server['ts'])
-                # if the timestamp is negative then we can assume this is
-                # a static entry and does not age out
-                if ts >= 0.0:
-                    age = time.time() - ts
-                    if age > float(params['maxage']):
-                        continue
-
-            # use default precision unless one is given in the parameters
-            precision = fdns.GCS_DISTANCE_PRECISION
-            if 'precision' in params:
-                precision = params['precision']
-
-            # calculate the distance between two lat,long pairs
-            dist = fdns.gcs_distance((lat, lon), (server['lat'], server['lon']))
-
-            # see if the zone specifies a maximum distance; a negative value
-            # (or the value is not present) means no limit
-            if 'maxdist' in params:
-                maxdist = float(params['maxdist'])
-                if maxdist >= 0.0 and dist > maxdist:
-                    continue
 
-            # check if the server is closer than (or the same distance as)
-            # previous servers. if not, it's not a candidate.
-            # if it's closer then we remove previous candidates.
-            # remember that this value is rounded by the "precision" value
-            # above.
-            if dist <= mindist:
-                if dist < mindist:
-                    # this result is closer, start a new list
-                    mindist = dist
-                    ranked = []
-                # keep this server
-                ranked.append(server)
+    """
+    Chooses which of the ranked servers to give a client.
 
+    @param ranked list The servers from rank(), or False.
+    @param client str The IPv4 or IPv6 address of the client.
+    @param params hash The selection parameters; see find_closest_server().
+    @return list The servers for the client, or False if there are none.
+    """
+    def select(self, ranked, client, params):
         # Nothing found? Drop out now.
-        if len(ranked) == 0:
+        if not ranked:
             return False
 
         # If we have more than one server we may need to choose one or a subset
@@ -227,3 +486,338 @@ class Geo(object):
 
         return ranked
 
+
+    """
+    Finds the candidates closest to the client from the servers kept for
+    the grid cell the client is in.
+
+    The cell holds its nearest servers in order of their distance from the
+    centre of the cell, and the client is no more than the cell radius
+    from the centre. So once a server that passes the filters has been
+    found at distance D from the centre, any server further than
+    D + 2 * radius + precision from the centre must land in a further
+    precision bucket than it, and need not be looked at. The servers
+    before that point are ranked exactly.
+
+    Only distances that obey the triangle inequality can be bounded like
+    this, which rules out the equirectangular approximation.
+
+    See _rank_numpy() for the other parameters and the filtering rules.
+
+    @param grid GeoGrid The grid for the servers.
+    @return list The server records found at the shortest distance, in
+                their original order, or None if the cell does not hold
+                enough servers to be sure and the servers must be ranked
+                without the grid.
+    """
+    def _rank_grid(self, servers, grid, client, mode, precision, maxload,
+            maxage, maxdist, rejected=None):
+        (index, cdist, radius) = grid.cell(client[0], client[1])
+        now = time.time()
+
+        # Walk the servers nearest the cell until past the bound
+        limit = None
+        nearby = []
+        for (i, d) in zip(index, cdist):
+            if i < 0:
+                break
+            if limit is not None and d > limit:
+                break
+            nearby.append(i)
+            if limit is None and self._passes(servers, i, now, maxload,
+                    maxage):
+                limit = d + 2.0 * radius + precision
+        else:
+            # We ran out of servers before passing the bound; that is only
+            # safe if the cell holds every server.
+            if len(index) < grid.count:
+                return None
+
+        p = fdns.prepare_point(client[0], client[1])
+        distance = fdns.PREPARED_DISTANCE[mode]
+        mindist = None
+        ranked = []
+        for i in sorted(nearby):
+            reason = self._rejects(servers, i, now, maxload, maxage)
+            if reason is not None:
+                self._reject(rejected, reason)
+                continue
+            dist = distance(p, servers.points[i])
+            dist = (dist // precision) * precision
+            if maxdist >= 0.0 and dist > maxdist:
+                self._reject(rejected, 'maxdist')
+                continue
+            if mindist is None or dist < mindist:
+                mindist = dist
+                ranked = []
+            if dist == mindist:
+                ranked.append(servers.servers[i])
+
+        return ranked
+
+
+    """
+    Finds the candidates closest to the client with the spatial indexes of
+    their groups.
+
+    The servers are walked nearest first until one passes the filters;
+    the servers in the same precision bucket as that one are then those
+    within the end of that bucket, which are all fetched at once and
+    ranked exactly. With maxdist, nothing beyond maxdist plus the
+    precision is looked at, since it would be filtered out anyway.
+
+    Like _rank_grid() this relies on the triangle inequality, so it is not
+    used for the equirectangular approximation. See _rank_numpy() for the
+    parameters and the filtering rules.
+
+    @return list The server records found at the shortest distance, in
+                their original order, or None if the indexes do not agree
+                with the servers and the servers must be ranked without
+                them.
+    """
+    def _rank_index(self, servers, client, mode, precision, maxload,
+            maxage, maxdist, rejected=None):
+        p = fdns.prepare_point(client[0], client[1])
+        vector = p[3:]
+        distance = fdns.PREPARED_DISTANCE[mode]
+        position = servers.position
+        now = time.time()
+
+        margin = fdns.GEO_INDEX_MARGIN
+        if maxdist >= 0.0:
+            horizon = fdns.miles_to_chord(maxdist + precision + margin)
+        else:
+            horizon = None
+
+        walk = heapq.merge(*[index.nearest(vector)
+            for index in servers.indexes])
+        nearest = None
+        skipped = []
+        for (chord, key) in walk:
+            if horizon is not None and chord > horizon:
+                break
+            i = position.get(key)
+            if i is None:
+                return None
+            reason = self._rejects(servers, i, now, maxload, maxage)
+            if reason is None:
+                nearest = i
+                break
+            skipped.append(reason)
+
+        # The servers skipped on the way are counted below, unless we stop
+        # here
+        if nearest is None:
+            for reason in skipped:
+                self._reject(rejected, reason)
+            return []
+
+        dist = distance(p, servers.points[nearest])
+        dist = (dist // precision) * precision
+        if maxdist >= 0.0 and dist > maxdist:
+            for reason in skipped + ['maxdist']:
+                self._reject(rejected, reason)
+            return []
+
+        # Everything in the same bucket, or possibly in it
+        chord = fdns.miles_to_chord(dist + precision + margin)
+        found = set()
+        for index in servers.indexes:
+            for key in index.within(vector, chord):
+                i = position.get(key)
+                if i is None:
+                    return None
+                found.add(i)
+
+        mindist = None
+        ranked = []
+        for i in sorted(found):
+            reason = self._rejects(servers, i, now, maxload, maxage)
+            if reason is not None:
+                self._reject(rejected, reason)
+                continue
+            dist = distance(p, servers.points[i])
+            dist = (dist // precision) * precision
+            if maxdist >= 0.0 and dist > maxdist:
+                self._reject(rejected, 'maxdist')
+                continue
+            if mindist is None or dist < mindist:
+                mindist = dist
+                ranked = []
+            if dist == mindist:
+                ranked.append(servers.servers[i])
+
+        return ranked
+
+
+    """
+    Whether a server passes the load and age filters; see _rank_numpy().
+
+    @param servers CandidateSet The candidates.
+    @param i int The index of the server.
+    @param now float The current time.
+    @param maxload float The maximum load, or None.
+    @param maxage float The maximum age of the last update, or None.
+    @return bool True if the server is still a candidate.
+    """
+    def _passes(self, servers, i, now, maxload, maxage):
+        return self._rejects(servers, i, now, maxload, maxage) is None
+
+
+    """
+    Why a server fails the load and age filters; see _passes().
+
+    @return str 'load' or 'maxage', or None if the server is still a
+                candidate.
+    """
+    def _rejects(self, servers, i, now, maxload, maxage):
+        load = servers.load[i]
+        if load < 0.0:
+            return 'load'
+        if maxload is not None and load > maxload:
+            return 'load'
+        if maxage is not None:
+            ts = servers.ts[i]
+            if ts >= 0.0 and now - ts > maxage:
+                return 'maxage'
+        return None
+
+
+    """
+    Counts candidates left out of a ranking; see rank().
+
+    @param rejected dict The counts, indexed by reason, or None.
+    @param reason str Why they were left out.
+    @param n int How many were.
+    """
+    def _reject(self, rejected, reason, n=1):
+        if rejected is not None and n:
+            rejected[reason] = rejected.get(reason, 0) + n
+
+
+    """
+    Applies one of the filters of _rank_numpy() to the candidates.
+
+    @param keep numpy.ndarray Which servers are still candidates.
+    @param drop numpy.ndarray Which servers the filter leaves out.
+    @param reason str The reason for leaving them out; see rank().
+    @param rejected dict The counts, indexed by reason, or None.
+    @return numpy.ndarray Which servers are still candidates.
+    """
+    def _filter_array(self, keep, drop, reason, rejected):
+        if rejected is not None:
+            self._reject(rejected, reason,
+                int(numpy.count_nonzero(keep & drop)))
+        return keep & ~drop
+
+
+    """
+    Finds the candidates closest to the client with NumPy, evaluating
+    all of the distances and filters as whole-array operations.
+
+    A server is not a candidate if it reports a negative load, meaning it
+    is unavailable, or a load above maxload; if its last update is older
+    than maxage, unless its timestamp is negative, meaning it is a static
+    entry; or if it is further than maxdist away.
+
+    @param servers CandidateSet The candidates.
+    @param client list A tuple of the client (lat, lon) coordinates.
+    @param mode str How distances are calculated; see GCS_DISTANCE_MODES.
+    @param precision float The rounding applied to distances.
+    @param maxload float The maximum load, or None.
+    @param maxage float The maximum age of the last update, or None.
+    @param maxdist float The maximum distance; negative for no limit.
+    @param rejected dict The number of servers left out for each reason,
+                which is added to, or None; see rank().
+    @return list The server records found at the shortest distance, in
+                their original order.
+    """
+    def _rank_numpy(self, servers, client, mode, precision, maxload,
+            maxage, maxdist, rejected=None):
+        if len(servers) == 0:
+            return []
+
+        p = fdns.prepare_point(client[0], client[1])
+
+        with numpy.errstate(invalid='ignore'):
+            dist = fdns.distance_array(numpy, mode, p, servers.lat,
+                servers.lon, servers.coslat, servers.x, servers.y, servers.z)
+            dist = (dist // precision) * precision
+
+            # The filters in the same order as _rank_python(), so that they
+            # count the same rejections
+            keep = numpy.ones(len(servers), dtype=bool)
+            drop = servers.load < 0.0
+            if maxload is not None:
+                drop |= servers.load > maxload
+            keep = self._filter_array(keep, drop, 'load', rejected)
+            if maxage is not None:
+                age = time.time() - servers.ts
+                keep = self._filter_array(keep,
+                    (servers.ts >= 0.0) & (age > maxage), 'maxage', rejected)
+            # Servers with no coordinates are not candidates, but that is
+            # not counted as a rejection
+            keep &= ~numpy.isnan(dist)
+            if maxdist >= 0.0:
+                keep = self._filter_array(keep, dist > maxdist, 'maxdist',
+                    rejected)
+
+        if not keep.any():
+            return []
+
+        mindist = dist[keep].min()
+        return [servers.servers[i] for i in
+            numpy.flatnonzero(keep & (dist == mindist))]
+
+
+    """
+    Finds the candidates closest to the client in a single Python loop
+    over the precomputed arrays. See _rank_numpy() for the parameters and
+    filtering rules.
+    """
+    def _rank_python(self, servers, client, mode, precision, maxload,
+            maxage, maxdist, rejected=None):
+        p = fdns.prepare_point(client[0], client[1])
+        distance = fdns.PREPARED_DISTANCE[mode]
+        now = time.time()
+
+        # The shortest distance discovered
+        mindist = None
+        # List of servers found at the shortest distance
+        ranked = []
+
+        for i in range(len(servers)):
+            # check server load, if applicable
+            load = servers.load[i]
+            if load < 0.0 or (maxload is not None and load > maxload):
+                self._reject(rejected, 'load')
+                continue
+
+            # check the timestamp of when we received the last update
+            if maxage is not None:
+                ts = servers.ts[i]
+                if ts >= 0.0 and now - ts > maxage:
+                    self._reject(rejected, 'maxage')
+                    continue
+
+            point = servers.points[i]
+            if point[0] != point[0]:
+                # NaN; no coordinates for this server
+                continue
+            dist = distance(p, point)
+            dist = (dist // precision) * precision
+
+            if maxdist >= 0.0 and dist > maxdist:
+                self._reject(rejected, 'maxdist')
+                continue
+
+            # keep servers closer than (or the same distance as) previous
+            # ones; if closer, start a new list
+            if mindist is None or dist < mindist:
+                mindist = dist
+                ranked = []
+            if dist == mindist:
+                ranked.append(servers.servers[i])
+
+        return ranked
+
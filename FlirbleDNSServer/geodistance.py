@@ -22,9 +22,148 @@ log = logging.getLogger(__file__)
 
 import math
 
+import FlirbleDNSServer as fdns
+
 """Default precision with which to return distance calculations."""
 GCS_DISTANCE_PRECISION = 50.0
 
+"""Miles per degree of arc along a great circle."""
+MILES_PER_DEGREE = 60 * 1.1515
+
+"""The radius of the earth, in miles, consistent with MILES_PER_DEGREE."""
+EARTH_RADIUS_MILES = MILES_PER_DEGREE * 180.0 / math.pi
+
+"""
+The ways distances can be calculated:
+
+* 'haversine' is accurate at all distances and well conditioned for
+  nearby points.
+* 'cosine' is the spherical law of cosines, evaluated as the dot product
+  of precomputed unit vectors. It needs the fewest operations per server
+  and is accurate to well under a mile at any distance.
+* 'equirectangular' treats the area between the two points as flat. It is
+  the cheapest in trig calls but becomes inaccurate over long distances
+  and at high latitudes.
+"""
+GCS_DISTANCE_MODES = ('haversine', 'cosine', 'equirectangular')
+
+"""Default way to calculate distances."""
+GCS_DISTANCE_MODE = 'haversine'
+
+
+"""
+Converts global coordinates into the terms the distance functions need,
+so they can be computed once for each server rather than on every query.
+
+@param lat float The latitude, in degrees.
+@param lon float The longitude, in degrees.
+@returns list A tuple of (lat, lon, cos(lat), x, y, z) where lat and lon
+            are in radians and (x, y, z) is the unit vector from the centre
+            of the earth.
+"""
+def prepare_point(lat, lon):
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    coslat = math.cos(lat)
+    return (lat, lon, coslat,
+            coslat * math.cos(lon),
+            coslat * math.sin(lon),
+            math.sin(lat))
+
+
+"""
+Converts global coordinates to a unit vector from the centre of the earth.
+The dot product of two such vectors is the cosine of the angle between
+them.
+
+@param lat float The latitude, in degrees.
+@param lon float The longitude, in degrees.
+@returns list A tuple of (x, y, z).
+"""
+def unit_vector(lat, lon):
+    return prepare_point(lat, lon)[3:]
+
+
+"""
+Haversine distance between two prepared points.
+
+@param p list A tuple from prepare_point().
+@param q list A tuple from prepare_point().
+@returns float The distance in miles.
+"""
+def haversine_prepared(p, q):
+    a = math.sin((q[0] - p[0]) / 2.0) ** 2 + \
+        p[2] * q[2] * math.sin((q[1] - p[1]) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+"""
+Spherical law of cosines distance between two prepared points.
+
+@param p list A tuple from prepare_point().
+@param q list A tuple from prepare_point().
+@returns float The distance in miles.
+"""
+def cosine_prepared(p, q):
+    dot = p[3] * q[3] + p[4] * q[4] + p[5] * q[5]
+    # rounding can push this just outside the domain of acos
+    dot = max(-1.0, min(1.0, dot))
+    return EARTH_RADIUS_MILES * math.acos(dot)
+
+
+"""
+Equirectangular approximation of the distance between two prepared points.
+
+@param p list A tuple from prepare_point().
+@param q list A tuple from prepare_point().
+@returns float The distance in miles.
+"""
+def equirectangular_prepared(p, q):
+    # take the short way around
+    dlon = (q[1] - p[1] + math.pi) % (2.0 * math.pi) - math.pi
+    x = dlon * math.cos((p[0] + q[0]) / 2.0)
+    y = q[0] - p[0]
+    return EARTH_RADIUS_MILES * math.sqrt(x * x + y * y)
+
+
+"""The function for each mode in GCS_DISTANCE_MODES."""
+PREPARED_DISTANCE = {
+    'haversine': haversine_prepared,
+    'cosine': cosine_prepared,
+    'equirectangular': equirectangular_prepared,
+}
+
+
+"""
+Calculates the distances from one point to many at once with NumPy.
+
+@param numpy module The NumPy module.
+@param mode str One of GCS_DISTANCE_MODES.
+@param p list A tuple from prepare_point() for the single point.
+@param lat array The latitudes of the other points, in radians.
+@param lon array The longitudes of the other points, in radians.
+@param coslat array The cosines of lat.
+@param x array The unit vector x components of the other points.
+@param y array The unit vector y components of the other points.
+@param z array The unit vector z components of the other points.
+@returns array The distances in miles; NaN where a point has no
+            coordinates.
+"""
+def distance_array(numpy, mode, p, lat, lon, coslat, x, y, z):
+    if mode == 'haversine':
+        a = numpy.sin((lat - p[0]) / 2.0) ** 2 + \
+            p[2] * coslat * numpy.sin((lon - p[1]) / 2.0) ** 2
+        return 2.0 * EARTH_RADIUS_MILES * \
+            numpy.arcsin(numpy.sqrt(numpy.clip(a, 0.0, 1.0)))
+
+    if mode == 'equirectangular':
+        dlon = (lon - p[1] + math.pi) % (2.0 * math.pi) - math.pi
+        return EARTH_RADIUS_MILES * \
+            numpy.hypot(dlon * numpy.cos((lat + p[0]) / 2.0), lat - p[0])
+
+    dot = numpy.clip(x * p[3] + y * p[4] + z * p[5], -1.0, 1.0)
+    return EARTH_RADIUS_MILES * numpy.arccos(dot)
+
 
 """
 Given two global coordinates, calculate the surface distance between
@@ -33,19 +172,13 @@ them in miles, bounded by the optional precision parameter.
 @param a list A tuple of (lat, long) coordinates.
 @param b list A tuple of (lat, long) coordinates.
 @param precision float The rounding to apply to the result. Default is 50.0.
+@param mode str How to calculate the distance, one of GCS_DISTANCE_MODES.
+            Default is GCS_DISTANCE_MODE.
 @returns float The distance between the two coordinates, in miles, rounded
 			down to the given precision.
 """
-def gcs_distance(a, b, precision=GCS_DISTANCE_PRECISION):
-
-    (lat1, lon1) = a
-    (lat2, lon2) = b
-
-    theta = lon1 - lon2;
-    dist = math.sin(math.radians(lat1)) * math.radians(math.radians(lat2)) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.cos(math.radians(theta));
-    dist = math.degrees(math.acos(dist));
-    miles = dist * 60 * 1.1515;
-
-    miles = (miles // precision) * precision
-
-    return miles;
+def gcs_distance(a, b, precision=GCS_DISTANCE_PRECISION, mode=None):
+    if mode is None:
+        mode = fdns.GCS_DISTANCE_MODE
+    miles = PREPARED_DISTANCE[mode](prepare_point(*a), prepare_point(*b))
+    return (miles // precision) * precision
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Precomputed nearest server grid
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import time, math, threading, traceback
+
+# The grid is built with NumPy; without it there is no grid.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import FlirbleDNSServer as fdns
+
+"""The size, in degrees of latitude and longitude, of each grid cell; zero
+   disables the grid."""
+GEO_GRID_RESOLUTION = 0.0
+
+"""The number of servers kept for each grid cell."""
+GEO_GRID_DEPTH = 8
+
+"""Miles added to the radius of each cell to allow for rounding."""
+GEO_GRID_MARGIN = 1.0
+
+
+"""
+The servers of a CandidateSet nearest to each cell of a latitude and
+longitude grid, ordered by their distance from the centre of the cell.
+
+This depends only on the coordinates of the servers, so it stays valid
+while their load and timestamps change; those are checked when the grid is
+used. See Geo._rank_grid() for how a client is ranked from its cell.
+"""
+class GeoGrid(object):
+
+    """The size of each cell, in degrees."""
+    resolution = None
+
+    """The number of rows (of latitude) and columns (of longitude)."""
+    rows = None
+    cols = None
+
+    """The number of servers kept for each cell."""
+    depth = None
+
+    """The number of servers that have coordinates."""
+    count = None
+
+    """The index in the CandidateSet of the nearest servers to each cell,
+    with -1 for unused slots, as an array of (rows * cols, depth)."""
+    index = None
+
+    """The distance in miles from the centre of each cell to each of those
+    servers."""
+    dist = None
+
+    """The distance in miles from the centre of a cell in each row to its
+    furthest corner, plus GEO_GRID_MARGIN."""
+    radius = None
+
+    """The coordinates the grid was built from; see coordinates()."""
+    coords = None
+
+
+    """
+    Builds the grid. This can take a while for a fine grid and many servers,
+    so is normally done by a GridBuilder.
+
+    @param servers CandidateSet The servers.
+    @param resolution float The size of each cell, in degrees.
+    @param depth int The number of servers to keep for each cell.
+    """
+    def __init__(self, servers, resolution=None, depth=None):
+        super(GeoGrid, self).__init__()
+
+        self.resolution = float(resolution or fdns.GEO_GRID_RESOLUTION)
+        self.depth = int(depth or fdns.GEO_GRID_DEPTH)
+        self.coords = coordinates(servers)
+        self.rows = int(math.ceil(180.0 / self.resolution))
+        self.cols = int(math.ceil(360.0 / self.resolution))
+
+        n = len(servers)
+        depth = min(self.depth, n)
+        vectors = numpy.array([servers.x, servers.y, servers.z], dtype=float)
+        valid = ~numpy.isnan(vectors[0])
+        self.count = int(valid.sum())
+
+        self.index = numpy.empty((self.rows * self.cols, self.depth),
+            dtype=numpy.int32)
+        self.index.fill(-1)
+        self.dist = numpy.empty((self.rows * self.cols, self.depth),
+            dtype=float)
+        self.dist.fill(numpy.inf)
+        self.radius = numpy.empty(self.rows, dtype=float)
+
+        half = self.resolution / 2.0
+        clons = numpy.radians(-180.0 + half +
+            numpy.arange(self.cols) * self.resolution)
+
+        for row in range(self.rows):
+            clat = -90.0 + half + row * self.resolution
+
+            # The corners are the furthest points of a cell from its centre
+            centre = fdns.prepare_point(clat, 0.0)
+            self.radius[row] = max([fdns.cosine_prepared(centre,
+                fdns.prepare_point(max(-90.0, min(90.0, lat)), half))
+                for lat in (clat - half, clat + half)]) + GEO_GRID_MARGIN
+
+            if depth == 0:
+                continue
+
+            coslat = math.cos(math.radians(clat))
+            centres = numpy.array([coslat * numpy.cos(clons),
+                coslat * numpy.sin(clons),
+                numpy.repeat(math.sin(math.radians(clat)), self.cols)]).T
+
+            with numpy.errstate(invalid='ignore'):
+                dot = numpy.clip(numpy.dot(centres, vectors), -1.0, 1.0)
+                miles = fdns.EARTH_RADIUS_MILES * numpy.arccos(dot)
+            miles[:, ~valid] = numpy.inf
+
+            # Pick out the nearest few to each cell, then sort those
+            cells = numpy.arange(self.cols)[:, None]
+            if depth < n:
+                nearest = numpy.argpartition(miles, depth - 1,
+                    axis=1)[:, :depth]
+            else:
+                nearest = numpy.tile(numpy.arange(n), (self.cols, 1))
+            near = miles[cells, nearest]
+            order = numpy.argsort(near, axis=1, kind='mergesort')
+            nearest = nearest[cells, order]
+            near = near[cells, order]
+            nearest[numpy.isinf(near)] = -1
+
+            start = row * self.cols
+            self.index[start:start + self.cols, :depth] = nearest
+            self.dist[start:start + self.cols, :depth] = near
+
+
+    """
+    Whether the grid was built from servers at the same coordinates as a
+    CandidateSet, in the same order, and so can be used with it.
+
+    @param servers CandidateSet The servers.
+    @return bool True if the grid can be used with the servers.
+    """
+    def matches(self, servers):
+        return self.coords == coordinates(servers)
+
+
+    """
+    Returns the nearest servers to the cell holding a location.
+
+    @param lat float The latitude, in degrees.
+    @param lon float The longitude, in degrees.
+    @return list A tuple of (index, dist, radius): the indices of the
+                servers, nearest first, with -1 for unused slots; their
+                distances from the centre of the cell; and the radius of
+                the cell.
+    """
+    def cell(self, lat, lon):
+        row = int((lat + 90.0) // self.resolution)
+        col = int((lon + 180.0) // self.resolution)
+        row = max(0, min(self.rows - 1, row))
+        col = col % self.cols
+        cell = row * self.cols + col
+        return (self.index[cell].tolist(), self.dist[cell].tolist(),
+            float(self.radius[row]))
+
+
+"""
+Returns the coordinates of a set of servers, in order, in a form that can
+be compared to tell whether a grid is still valid.
+
+@param servers CandidateSet The servers.
+@return tuple The (lat, lon) of each server, or None for a server without
+            coordinates.
+"""
+def coordinates(servers):
+    # NaN never compares equal, so it can't be used here
+    return tuple([p[:2] if p[0] == p[0] else None for p in servers.points])
+
+
+"""
+Builds grids in a background thread and attaches them to the CandidateSet
+they were built for, so that nothing waits for them. Until its grid is
+ready a CandidateSet is ranked without one.
+
+A request to build a grid for a set of groups replaces any earlier request
+for the same groups that has not started yet; the most recent CandidateSet
+for those groups is built when the thread gets to it.
+"""
+class GridBuilder(object):
+
+    """A function that returns the current CandidateSet for a tuple of
+    groups, or None."""
+    lookup = None
+
+    """The groups waiting for a grid, in order."""
+    pending = None
+
+    """Guards self.pending."""
+    cond = None
+
+    """The thread."""
+    thread = None
+
+    """Counters; see stats()."""
+    built = 0
+    failed = 0
+    seconds = 0.0
+
+
+    """
+    @param lookup function Called with a tuple of groups to get their
+                current CandidateSet.
+    """
+    def __init__(self, lookup):
+        super(GridBuilder, self).__init__()
+
+        self.lookup = lookup
+        self.pending = []
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run,
+            name='GridBuilder')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    """
+    Asks for the grid of a set of groups to be built.
+
+    @param groups tuple The groups.
+    """
+    def submit(self, groups):
+        with self.cond:
+            if groups not in self.pending:
+                self.pending.append(groups)
+            self.cond.notify()
+
+
+    """
+    Returns a snapshot of the builder counters.
+
+    @return dict With these items:
+                * built The number of grids built.
+                * failed The number of grids that failed to build.
+                * seconds The time spent building them.
+                * pending The number of grids waiting to be built.
+    """
+    def stats(self):
+        with self.cond:
+            return {
+                'built': self.built,
+                'failed': self.failed,
+                'seconds': self.seconds,
+                'pending': len(self.pending),
+            }
+
+
+    """
+    The body of the builder thread.
+    """
+    def _run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                groups = self.pending.pop(0)
+
+            servers = self.lookup(groups)
+            if servers is None or len(servers) == 0:
+                continue
+            if servers.grid is not None and servers.grid.matches(servers):
+                continue
+
+            start = time.time()
+            try:
+                grid = GeoGrid(servers)
+            except Exception:
+                log.error("Failed to build the grid for %s: %s" %
+                    (repr(groups), traceback.format_exc()))
+                with self.cond:
+                    self.failed += 1
+                continue
+            elapsed = time.time() - start
+
+            # The servers may have changed while we worked; the grid is
+            # good for the current set as long as none of them moved.
+            current = self.lookup(groups)
+            if current is not None and grid.matches(current):
+                current.grid = grid
+
+            with self.cond:
+                self.built += 1
+                self.seconds += elapsed
+
+            if fdns.debug:
+                log.debug("Built the grid for %s in %.3f seconds." %
+                    (repr(groups), elapsed))
@@ -20,7 +20,8 @@
 import os, logging
 log = logging.getLogger(os.path.basename(__file__))
 
-import sys, json, threading, collections, time, copy
+import sys, json, threading, collections, time, struct
+import traceback
 import dnslib
 
 import FlirbleDNSServer as fdns
@@ -34,6 +35,41 @@ DEFAULT_SOA_TIMES = [ "%serial", 3600, 10800, 86400, 3600 ]
 """Time to cache Geo results for."""
 GEO_CACHE_TTL = 5
 
+"""Maximum number of Geo results to cache."""
+GEO_CACHE_SIZE = 65536
+
+"""
+How clients are grouped in the Geo cache:
+
+* 'network' uses the network the GeoIP database holds the client location
+  for, so every client in that network shares a result. This still does a
+  GeoIP lookup for each query that is not in the packet cache.
+* 'mask' uses the client address masked to GEO_CACHE_V4_PREFIX or
+  GEO_CACHE_V6_PREFIX bits, which avoids the GeoIP lookup when the result
+  is cached, at the risk of sharing a result across networks the database
+  places apart.
+"""
+GEO_CACHE_KEYS = ('network', 'mask')
+
+"""Default way to group clients in the Geo cache."""
+GEO_CACHE_KEY = 'network'
+
+"""Prefix lengths that client addresses are masked to for the Geo cache,
+   either when GEO_CACHE_KEY is 'mask' or when the network is unknown."""
+GEO_CACHE_V4_PREFIX = 24
+GEO_CACHE_V6_PREFIX = 48
+
+"""The granularity, in seconds, of SOA serial numbers generated from the
+   current time with "%serial"."""
+SOA_SERIAL_INTERVAL = 10
+
+"""Maximum number of replies to keep in the packet cache."""
+PACKET_CACHE_SIZE = 10000
+
+"""The name the query counters of names that are not zones are kept under,
+   in place of the zone name."""
+NO_ZONE = '(none)'
+
 """A logging filter used when dumping the received and sent DNS packets; this
    filter handes the multiline output of dnslib when serializing such data."""
 class ZoneLoggingFilter(logging.Filter):
@@ -67,20 +103,83 @@ This supports two types of zone currently:
 """
 class Request(object):
 
+    """Locks serializing changes to self.zones and self.servers. Readers
+    do not need them."""
     zlock = None
     slock = None
-    """A lock around self.geo_cache."""
-    glock = None
 
     rdb = None
     zones_table = None
     servers_table = None
+    """Set once the current contents of the zones and servers tables have
+    been loaded; until then replies would be built from partial data."""
+    ready = None
+    """The tables that have not been loaded yet."""
+    _loading = None
+
+    """The file the zones and servers are saved to, and loaded from at
+    startup, if any."""
+    snapshot = None
+    """The store version last saved to self.snapshot, and when."""
+    _snapshot_version = None
+    _snapshot_time = 0
     geo = None
-    """A cache of servers returned by geo lookups for a client."""
+    """A cache of the servers ranked for a client network, indexed by
+    (network, groups, params) and tagged with ('group', name) for each
+    group. Each value is a tuple of (expires, ranked, rejected), where
+    rejected is the number of servers left out of the ranking for each
+    reason; see Geo.rank()."""
     geo_cache = None
 
+    """The zones and servers, kept up to date from the changefeeds."""
+    store = None
+    """The zones, indexed by name. This and self.servers are immutable
+    snapshots published from self.store once everything derived from them
+    is ready, so readers can take a reference and use it without locking
+    or copying."""
     zones = None
+    """The servers, indexed by group and then name."""
     servers = None
+    """The CandidateSet for each tuple of groups used by a zone, ready
+    to hand to Geo.find_closest_server(). Also an immutable snapshot,
+    maintained by the callbacks under slock."""
+    candidates = None
+    """Builds a GeoGrid for each CandidateSet in the background, if
+    enabled by GEO_GRID_RESOLUTION."""
+    grid_builder = None
+    """The SpatialIndex of the servers in each group, if enabled by
+    GEO_INDEX_THRESHOLD. Also an immutable snapshot, maintained under
+    slock."""
+    spatial = None
+
+    """A lock around self.compiled and self.compiled_deps."""
+    clock = None
+    """Pre-packed replies for static zones, indexed by (qname, qtype, qclass).
+    Each entry is a tuple of (packet, expires, counts) where expires is None
+    if the packet does not go stale by itself and counts are the counters
+    to add each time the packet is used; see RequestState.counts."""
+    compiled = None
+    """The keys in self.compiled that depend on each zone name."""
+    compiled_deps = None
+    """Incremented whenever zone data changes, so that a compile that raced
+    with a change is not stored."""
+    _zone_generation = 0
+
+    """A cache of packed replies that could not be compiled, typically
+    because they depend on the client, indexed by the question, EDNS
+    details and the geo_cache keys the reply used. Each value is a tuple
+    of (packet, counts), as in self.compiled."""
+    packet_cache = None
+    """For each question in the packet cache, the (groups, params) part of
+    the geo_cache keys its reply used; the client completes them."""
+    packet_shapes = None
+
+    """Counters of the queries for each zone, kept as 'Zone <name>', and
+    of the replies each server was given in, kept as 'Server <name>'; see
+    stats(). The counts that depend on how a reply was built are kept with
+    the reply in self.compiled and self.packet_cache, so that they are
+    counted again each time it is used."""
+    counters = None
 
 
     """
@@ -89,8 +188,10 @@ class Request(object):
     @param servers str The servers table to fetch server data from.
     @param geo Geo An instance of a Geo object that can be used to perform
                 geographic lookups and calculations.
+    @param snapshot str A file to save the zones and servers to, and to
+                load them from before the tables are loaded, if any.
     """
-    def __init__(self, rdb, zones, servers, geo=None):
+    def __init__(self, rdb, zones, servers, geo=None, snapshot=None):
         super(Request, self).__init__()
 
         self.zlock = threading.Lock()
@@ -100,64 +201,311 @@ class Request(object):
         self.zones_table = zones
         self.servers_table = servers
 
-        self.zones = {}
-        self.servers = {}
+        self.store = fdns.Store()
+        self.zones = self.store.zones
+        self.servers = self.store.servers
+        self.candidates = fdns.FrozenDict({('default',): fdns.CandidateSet(())})
+        self.spatial = fdns.FrozenDict()
 
-        if rdb is not None:
-            rdb.register_table(zones, self._zones_cb)
-            rdb.register_table(servers, self._servers_cb)
+        self.clock = threading.Lock()
+        self.compiled = {}
+        self.compiled_deps = {}
+
+        self.packet_cache = fdns.LRUCache(PACKET_CACHE_SIZE)
+        self.packet_shapes = fdns.LRUCache(PACKET_CACHE_SIZE)
+        self.counters = fdns.Counters()
 
         if geo is not None:
             self.geo = geo
-            self.geo_cache = {}
-            self.glock = threading.Lock()
+            self.geo_cache = fdns.LRUCache(fdns.GEO_CACHE_SIZE)
+
+            if fdns.GEO_GRID_RESOLUTION > 0:
+                if fdns.grid.numpy is None:
+                    log.warning("The geo grid needs NumPy; not using it.")
+                else:
+                    self.grid_builder = fdns.GridBuilder(
+                        lambda groups: self.candidates.get(groups))
+
+        self.ready = threading.Event()
+        self._loading = set()
+
+        # Answer from the last snapshot until the tables have loaded
+        self.snapshot = snapshot
+        if snapshot is not None:
+            self.load_snapshot()
+
+        if rdb is not None:
+            self._loading.update((zones, servers))
+            rdb.register_table(zones, self._zones_cb)
+            rdb.register_table(servers, self._servers_cb)
+        else:
+            self.ready.set()
 
 
     """
     Callback for initial and updates to the distributed Zones database.
     """
-    def _zones_cb(self, rdb, change):
-        with self.zlock:
-            if fdns.debug:
-                log.debug("Zone change: %s" % json.dumps(change, sort_keys=True,
-                                        indent=4, separators=(',', ': ')))
-            new = change["new_val"]
-            self.zones[new['name']] = new
+    def _zones_cb(self, rdb, changes, initial=False):
+        if fdns.debug:
+            for change in changes:
+                log.debug("Zone change: %s" % json.dumps(change,
+                    sort_keys=True, indent=4, separators=(',', ': ')))
+        if initial:
+            # This is the whole table; anything else we have is gone
+            changes = changes + self.store.zone_removals(
+                [c['new_val'] for c in changes if c.get('new_val')])
+        self.apply(zones=changes)
+        self._loaded(self.zones_table)
 
 
     """
     Callback for initial and updates to the distributed Servers database.
     """
-    def _servers_cb(self, rdb, change):
-        with self.slock:
-            if fdns.debug:
-                log.debug("Server change: %s" % json.dumps(change, sort_keys=True,
-                                        indent=4, separators=(',', ': ')))
-            new = change["new_val"]
-
-            # Work out if the server is part of a group; if not, it implies
-            # a group with the same name as the server
-            if ',' in new['name']:
-                (group, name) = new['name'].split(',')
-            elif '!' in new['name']:
-                (group, name) = new['name'].split('!')
+    def _servers_cb(self, rdb, changes, initial=False):
+        if fdns.debug:
+            for change in changes:
+                log.debug("Server change: %s" % json.dumps(change,
+                    sort_keys=True, indent=4, separators=(',', ': ')))
+        if initial:
+            changes = changes + self.store.server_removals(
+                [c['new_val'] for c in changes if c.get('new_val')])
+        self.apply(servers=changes)
+        self._loaded(self.servers_table)
+
+
+    """
+    Notes that a table has been loaded, and sets self.ready once they all
+    have been.
+
+    @param table str The name of the table.
+    """
+    def _loaded(self, table):
+        with self.zlock:
+            if table not in self._loading:
+                return
+            self._loading.discard(table)
+            if len(self._loading) == 0:
+                log.info("Loaded %d zones and %d servers; ready." %
+                    (len(self.zones), sum([len(g)
+                    for g in self.servers.values()])))
+                self.ready.set()
+
+
+    """
+    Loads the zones and servers from self.snapshot, and if there are any
+    sets self.ready so that queries are answered from them until the
+    tables have loaded.
+
+    @return bool True if the snapshot was loaded.
+    """
+    def load_snapshot(self):
+        start = time.time()
+        data = fdns.load_snapshot(self.snapshot)
+        if data is None:
+            return False
+
+        delta = self.apply(
+            zones=[{'new_val': zone} for zone in data['zones']],
+            servers=[{'new_val': server} for server in data['servers']])
+        self._snapshot_version = delta.version
+
+        log.info("Loaded %d zones and %d servers from snapshot '%s', " \
+            "saved %d seconds ago, in %.3f seconds." %
+            (len(data['zones']), len(data['servers']), self.snapshot,
+            start - data['saved'], time.time() - start))
+        self.ready.set()
+        return True
+
+
+    """
+    Saves the zones and servers to self.snapshot if they have changed
+    since it was last saved. Nothing is saved until they are ready, so that
+    a good snapshot is not replaced with part of one.
+
+    @return bool True if a snapshot was saved.
+    """
+    def save_snapshot(self):
+        if self.snapshot is None or not self.ready.is_set():
+            return False
+
+        # Take a consistent view of the store
+        with self.zlock:
+            with self.slock:
+                version = self.store.version
+                zones = self.store.zones
+                servers = self.store.servers
+
+        if version == self._snapshot_version:
+            return False
+        if not fdns.save_snapshot(self.snapshot, zones, servers, version):
+            return False
+
+        self._snapshot_version = version
+        self._snapshot_time = time.time()
+        return True
+
+
+    """
+    Applies changes to the zones and servers, then brings everything
+    derived from them up to date and drops the cached replies they
+    affect, and only those.
+
+    @param zones list Changes to the zones, in the form of RethinkDB
+                changefeed entries; see Store.
+    @param servers list Changes to the servers, likewise.
+    @return StoreDelta What changed.
+    """
+    def apply(self, zones=(), servers=()):
+        with self.zlock:
+            with self.slock:
+                delta = self.store.apply(zones, servers)
+                if delta.empty():
+                    return delta
+
+                # Move the changed servers in the spatial indexes
+                if fdns.GEO_INDEX_THRESHOLD > 0 and len(delta.servers):
+                    self._index_servers(delta)
+
+                self.servers = self.store.servers
+
+                # Refresh the candidate lists the changed servers are in,
+                # and make sure there is one for each zone before the zone
+                # is visible
+                groupsets = set([groups for groups in self.candidates
+                    if len(delta.groups.intersection(groups))])
+                for name in delta.zones:
+                    zone = self.store.zones.get(name)
+                    if zone is not None and '_groups' in zone and \
+                            zone['_groups'] not in self.candidates:
+                        groupsets.add(zone['_groups'])
+                self._index_candidates(list(groupsets))
+
+                self.zones = self.store.zones
+
+                # Drop the candidate lists no zone uses any more
+                if len(delta.zones):
+                    self._prune_candidates()
+
+        if len(delta.zones):
+            self._recompile(sorted(delta.zones))
+
+        tags = [('zone', name) for name in delta.zones] + \
+            [('group', group) for group in delta.structural]
+        if len(tags):
+            self._invalidate_packets(tags)
+
+        if fdns.debug:
+            log.debug("Applied version %d: zones %s, groups %s." %
+                (delta.version, repr(sorted(delta.zones)),
+                repr(sorted(delta.groups))))
+
+        return delta
+
+
+    """
+    Updates the spatial indexes of the groups with changed servers and
+    publishes a new self.spatial. slock must be held.
+
+    @param delta StoreDelta The changes.
+    """
+    def _index_servers(self, delta):
+        spatial = dict(self.spatial)
+
+        # Groups with many changes, such as when they are first loaded, are
+        # quicker to build from scratch
+        counts = collections.Counter([group for (group, name)
+            in delta.servers])
+        rebuild = set([group for (group, count) in counts.items()
+            if count * 4 >= len(spatial.get(group, ()))])
+        for group in rebuild:
+            vectors = {}
+            for server in self.store.servers.get(group, {}).values():
+                if 'lat' in server and 'lon' in server:
+                    vectors[server['name']] = fdns.unit_vector(
+                        float(server['lat']), float(server['lon']))
+            if len(vectors):
+                spatial[group] = fdns.SpatialIndex(vectors)
             else:
-                group = new['name']
-                name = new['name']
+                spatial.pop(group, None)
+
+        for ((group, name), (old, new)) in delta.servers.items():
+            if group in rebuild:
+                continue
+            index = spatial.get(group, fdns.SpatialIndex())
+            if old is not None and (new is None or
+                    old['name'] != new['name']):
+                index = index.remove(old['name'])
+            if new is not None:
+                if 'lat' in new and 'lon' in new:
+                    index = index.update(new['name'], float(new['lat']),
+                        float(new['lon']))
+                else:
+                    index = index.remove(new['name'])
+            if len(index):
+                spatial[group] = index
+            else:
+                spatial.pop(group, None)
+        self.spatial = fdns.FrozenDict(spatial)
 
-            if fdns.debug:
-                log.debug("Updating group '%s' server '%s'." % (group, name))
 
-            if group not in self.servers:
-                self.servers[group] = {}
+    """
+    Rebuilds the candidate server lists for some tuples of groups from the
+    current servers snapshot and publishes a new self.candidates. slock
+    must be held.
+
+    @param groupsets list The tuples of group names to rebuild.
+    """
+    def _index_candidates(self, groupsets):
+        if len(groupsets) == 0:
+            return
+
+        snapshot = self.servers
+        candidates = dict(self.candidates)
+        rebuild = []
+        for groups in groupsets:
+            servers = []
+            for group in groups:
+                if group in snapshot:
+                    servers.extend(snapshot[group].values())
+            cs = fdns.CandidateSet(servers)
 
-            # IF the timestamp is missing, add one
-            if 'ts' not in new:
-                new['ts'] = time.time()
+            # Large sets are ranked with the spatial indexes of their groups
+            threshold = fdns.GEO_INDEX_THRESHOLD
+            if threshold > 0 and len(cs) >= threshold:
+                cs.indexes = tuple([self.spatial[group]
+                    for group in set(groups) if group in self.spatial])
 
-            # Store the new details
-            self.servers[group][name] = new
+            # A grid stays good until servers move, come or go
+            old = candidates.get(groups)
+            if old is not None and old.grid is not None and \
+                    old.grid.matches(cs):
+                cs.grid = old.grid
+            elif self.grid_builder is not None and len(cs) != 0:
+                rebuild.append(groups)
 
+            candidates[groups] = cs
+        self.candidates = fdns.FrozenDict(candidates)
+
+        for groups in rebuild:
+            self.grid_builder.submit(groups)
+
+
+    """
+    Drops the candidate lists that no zone uses, apart from the default
+    one, and publishes a new self.candidates. slock must be held.
+    """
+    def _prune_candidates(self):
+        used = set([zone['_groups'] for zone in self.store.zones.values()
+            if '_groups' in zone])
+        used.add(('default',))
+        unused = [groups for groups in self.candidates if groups not in used]
+        if len(unused) == 0:
+            return
+
+        candidates = dict(self.candidates)
+        for groups in unused:
+            del(candidates[groups])
+        self.candidates = fdns.FrozenDict(candidates)
 
 
     """
@@ -174,11 +522,95 @@ class Request(object):
     @returns str A raw, complete DNS reply packet.
     """
     def handler(self, data, address):
-        request = dnslib.DNSRecord.parse(data)
+        # Most queries can be answered from a ready-made reply, for which
+        # only the question is needed; dnslib parses the rest.
+        request = None
+        question = fdns.parse_question(data)
+        if question is None or fdns.debug:
+            request = dnslib.DNSRecord.parse(data)
+            if fdns.debug:
+                log.debug("Request received:", extra={'zone': str(request)})
+        if question is None:
+            question = (request.header.id, str(request.q.qname),
+                request.q.qtype, request.q.qclass, self._edns_key(request))
+        (qid, qname, qtype, qclass, edns) = question
+
+        counter = 'Zone ' + (qname if qname in self.zones else NO_ZONE)
+        self.counters.add(counter, 'queries')
+
+        # Static answers are pre-packed; we only need to set the ID.
+        key = (qname, qtype, qclass)
+        entry = self._get_compiled(key)
+        if entry is not None:
+            if fdns.debug:
+                log.debug("Reply from compiled zone data.")
+            self.counters.add(counter, 'cached')
+            self._add_counts(entry[1])
+            return struct.pack('!H', qid) + entry[0][2:]
+
+        # Then look for a recent identical reply to the same client scope.
+        base = key + (edns,)
+        client = self._client_address(address)
+        now = time.time()
+        shape = self.packet_shapes.get(base, now)
+        if shape is None:
+            shape = ()
+        pkey = base + tuple([(client,) + gk for gk in shape])
+        entry = self.packet_cache.get(pkey, now)
+        if entry is not None:
+            if fdns.debug:
+                log.debug("Reply from packet cache.")
+            self.counters.add(counter, 'cached')
+            self._add_counts(entry[1])
+            return struct.pack('!H', qid) + entry[0][2:]
+
+        # Zone or server data that changes while we resolve makes the reply
+        # stale
+        generation = self._zone_generation
+        pgeneration = self.packet_cache.generation
+        sgeneration = self.packet_shapes.generation
+
+        try:
+            if request is None:
+                request = dnslib.DNSRecord.parse(data)
+            state = self.resolve(request, address)
+
+            if fdns.debug:
+                log.debug("Reply to send:", extra={'zone': str(state.reply)})
+
+            packet = fdns.pack_reply(state.reply, state.answers)
+        except Exception:
+            self.counters.add(counter, 'errors')
+            raise
+
+        if state.header.rcode == dnslib.RCODE.REFUSED:
+            state.count(counter, 'refused')
+        self._add_counts(state.counts)
+
+        if self._compilable(key, state):
+            self._put_compiled(key, packet, state, generation)
+        else:
+            shape = tuple(state.geo_keys)
+            pkey = base + tuple([(client,) + gk for gk in shape])
+            tags = [('zone', name) for name in state.zones] + \
+                [('group', group) for group in state.groups]
+            self.packet_shapes.put(base, shape, state.expires, tags,
+                generation=sgeneration)
+            self.packet_cache.put(pkey, (packet, tuple(state.counts)),
+                state.expires, tags, generation=pgeneration)
+        return packet
 
-        if fdns.debug:
-            log.debug("Request received:", extra={'zone': str(request)})
 
+    """
+    Works out the reply to a parsed DNS query.
+
+    Since this may be called from threads, this is reentrant.
+
+    @params request DNSRecord The parsed query.
+    @params address str The IP address from which the query originated.
+    @returns RequestState The state of the request, including the reply.
+    """
+    def resolve(self, request, address):
         # Create a state-tracking object for this request.
         state = RequestState()
 
@@ -220,10 +652,46 @@ class Request(object):
             if status is False:
                 state.header.rcode = dnslib.RCODE.REFUSED
 
-        if fdns.debug:
-            log.debug("Reply to send:", extra={'zone': str(state.reply)})
+        return state
 
-        return state.reply.pack()
+
+    """
+    Builds a SERVFAIL reply for a raw DNS query without parsing it with
+    dnslib. This is used when a request can not be processed normally, for
+    example because the handler queue is full, so it only looks at the
+    header and copies the question, if there is one, as-is.
+
+    @params data str A raw DNS datagram.
+    @returns str A raw DNS reply packet, or None if the datagram is too
+                malformed to reply to.
+    """
+    def servfail(self, data):
+        data = bytearray(data)
+        if len(data) < 12:
+            return None
+
+        (qid, flags, qdcount) = struct.unpack('!HHH', bytes(data[:6]))
+        if flags & 0x8000:
+            # It's a response, not a query
+            return None
+
+        # Find the end of the question so we can copy it into the reply
+        question = ''
+        if qdcount == 1:
+            i = 12
+            while i < len(data):
+                l = data[i]
+                if l == 0 or l & 0xc0:
+                    break
+                i += l + 1
+            if i < len(data) and data[i] == 0 and i + 5 <= len(data):
+                question = bytes(data[12:i + 5])
+
+        # Keep the opcode and RD bits; set QR and the rcode
+        flags = 0x8000 | (flags & 0x7900) | dnslib.RCODE.SERVFAIL
+
+        return struct.pack('!HHHHHH', qid, flags, 1 if question else 0,
+            0, 0, 0) + question
 
 
     """
@@ -240,6 +708,9 @@ class Request(object):
                 matching reply records. None is returned on any error.
     """
     def handle_zone(self, qname, qtype, state, fn=None):
+        # Only the question itself is asked without fn
+        question = fn is None
+
         if fdns.debug:
             log.debug("handle_zone qname=%s qtype=%s" % (qname, qtype))
 
@@ -250,28 +721,30 @@ class Request(object):
                     "qname=%s qtype=%s" % (qname, qtype))
             return None
         state.chain.append(qname)
+        state.zones.add(qname)
 
         # Assume that if otherwise unspecified, we add answers
         if fn is None:
             fn = state.reply.add_answer
 
         # Do we awnser for such a zone?
-        with self.zlock:
-            if qname in self.zones:
-                if fdns.paranoid:
-                    zone = copy.deepcopy(self.zones[qname])
-                else:
-                    zone = self.zones[qname]
-            else:
-                zone = None
+        zone = self.zones.get(qname)
 
         # Dispatch appropriately.
+        found = None
         if zone is not None:
             if zone['type'] == 'static':
-                return self.handle_static(qname, qtype, zone, state, fn)
+                found = self.handle_static(qname, qtype, zone, state, fn)
+
+            elif zone['type'] == 'geo-dist':
+                # The answer depends on who is asking
+                state.static = False
+                found = self.handle_geo_dist(qname, qtype, zone, state, fn)
 
-            if zone['type'] == 'geo-dist':
-                return self.handle_geo_dist(qname, qtype, zone, state, fn)
+        if found is not None:
+            if question and not found:
+                state.count('Zone ' + qname, 'nodata')
+            return found
 
         if fdns.debug:
             log.debug("handle_zone qname=%s qtype=%s not found" %
@@ -312,6 +785,10 @@ class Request(object):
             if self._check_qtype(q, ('ANY', rr['type'])):
                 found = True
                 rdata = self._construct_rdata(rr)
+                if rr['type'] == 'SOA' and self._is_serial_from_time(rr):
+                    # The serial number changes with the clock
+                    state.expire((int(time.time() / SOA_SERIAL_INTERVAL) +
+                        1) * SOA_SERIAL_INTERVAL)
                 rtype = getattr(dnslib.QTYPE, rr['type'])
                 self._add(state, fn, dnslib.RR(rname=qname, rtype=rtype,
                     ttl=ttl, rdata=rdata))
@@ -369,63 +846,44 @@ class Request(object):
         if 'geo_cache_ttl' in zone:
             geo_cache_ttl = int(zone['geo_cache_ttl'])
 
-        # Determine the set of servers to look at
-        servers = None
-        groups = None
-        with self.slock:
-            servers = []
-            if 'groups' in zone:
-                # Parse the servers group list
-                groups = zone['groups']
+        # A ranking from servers that change meanwhile is not cached
+        generation = None
+        if self.geo_cache is not None:
+            generation = self.geo_cache.generation
+
+        # Fetch the prepared list of servers to look at. self.candidates
+        # is an immutable snapshot so we can use it as-is.
+        candidates = self.candidates
+        groups = zone.get('_groups')
+        servers = ()
+        if groups is not None:
+            if fdns.debug:
+                log.debug("Found 'groups' in zone: '%s'." % repr(groups))
+            servers = candidates.get(groups, ())
 
+        counter = 'Zone ' + qname
+
+        # If no servers in the list, try to use the default set
+        if len(servers) == 0:
+            servers = candidates.get(('default',), ())
+            if len(servers) != 0:
                 if fdns.debug:
-                    log.debug("Found 'groups' in zone: '%s'." % groups)
+                    log.debug("No servers found; using default.")
+                groups = ('default',)
+                state.count(counter, 'default')
+            elif fdns.debug:
+                log.debug("No servers found; no default found; " \
+                    "expect a non-geo reponse")
 
-                if "," in groups:
-                    groups = tuple(groups.split(","))
-                elif isinstance(groups, list) or isinstance(groups, tuple):
-                    groups = tuple(groups)
-                else:
-                    if fdns.paranoid:
-                        groups = (copy.copy(groups),)
-                    else:
-                        groups = (groups,)
-
-                # Collate the server data
-                for group in groups:
-                    if group in self.servers:
-                        # Build a list of the servers (extract the list from the dict)
-                        for name in self.servers[group]:
-                            server = self.servers[group][name]
-                            if fdns.paranoid:
-                                servers.append(copy.deepcopy(server))
-                            else:
-                                servers.append(server)
-
-            # If no servers added to the list, try to use the default set
-            if len(servers) == 0:
-                if 'default' in self.servers:
-                    if fdns.debug:
-                        log.debug("No servers found; using default.")
-                    groups = ('default',)
-                    if fdns.paranoid:
-                        servers = copy.copy(self.servers['default'])
-                    else:
-                        servers = self.servers['default']
-                else:
-                    if fdns.debug:
-                        log.debug("No servers found; no default found; " \
-                            "expect a non-geo reponse")
-                    servers_set = ('unknown',)
 
+        # Replies built from here depend on these groups
+        if groups is not None:
+            state.groups.update(groups)
+        state.groups.add('default')
 
         # if we have servers to look at...
         if self.geo is not None and len(servers) != 0:
-            # check if we were given an ipv6-encoded-as-ipv6 address
-            client = state.address[0]
-            if client.startswith('::ffff:'):
-                # strip the ipv6 part
-                client = client[7:]
+            client = self._client_address(state.address)
 
             # if we have paramaters, use them
             if 'params' in zone:
@@ -433,44 +891,79 @@ class Request(object):
             else:
                 params = {}
 
-            selected = None
+            # The ranking depends only on where the client is, so it is
+            # cached for the client network rather than the client address.
+            location = None
+            network = None
+            if fdns.GEO_CACHE_KEY == 'network':
+                location = self.geo.locate(client)
+                if location:
+                    network = location[2]
+            if network is None:
+                network = fdns.client_network(client,
+                    fdns.GEO_CACHE_V4_PREFIX, fdns.GEO_CACHE_V6_PREFIX)
+            if network is None:
+                network = client
 
             # do we have a cached entry?
             # build a composite key that includes the selection parameters
             spar = tuple(sorted((key,value) for (key,value) in params.items()))
-            skey = (client, groups, spar)
-            with self.glock:
-                if skey in self.geo_cache:
-                    s = self.geo_cache[skey]
-                    # check the entry age - only use if not expired
-                    if time.time() < s[0]:
-                        selected = s[1]
-                        if fdns.debug:
-                            log.debug('handle_geo_dist using cached result " \
-                                "for %s' % repr(skey))
-
-            # No cached entry; we need to go work it out
-            if selected is None:
-                # go find the closest set of servers to the client address
+            skey = (network, groups, spar)
+            state.geo_keys.append((groups, spar))
+            now = time.time()
+            entry = self.geo_cache.get(skey, now)
+            if entry is not None:
+                (expires, ranked, rejected) = entry
+                state.expire(expires)
+                if fdns.debug:
+                    log.debug("handle_geo_dist using cached result " \
+                        "for %s" % repr(skey))
+            else:
+                # No cached entry; we need to go work it out
                 if fdns.debug:
-                    log.debug('handle_geo_dist using calculated result " \
-                        for %s' % repr(skey))
+                    log.debug("handle_geo_dist using calculated result " \
+                        "for %s" % repr(skey))
 
-                selected = self.geo.find_closest_server(servers, client, params)
+                if location is None:
+                    location = self.geo.locate(client)
+                ranked = location
+                rejected = {}
+                if location:
+                    ranked = self.geo.rank(servers, location, params,
+                        rejected)
 
-                with self.glock:
-                    self.geo_cache[skey] = (
-                        time.time() + geo_cache_ttl,
-                        selected
-                    )
+                expires = now + geo_cache_ttl
+                state.expire(expires)
+                self.geo_cache.put(skey, (expires, ranked, rejected), expires,
+                    [('group', group) for group in groups], now=now,
+                    generation=generation)
+
+            for (reason, n) in rejected.items():
+                state.count(counter, 'rejected_' + reason, n)
+
+            # pick the servers for this client from the ranked list
+            selected = self.geo.select(ranked, client, params)
 
             # Don't need these anymore
-            del(skey, spar, servers, groups)
+            del(skey, spar, servers, groups, location, network)
 
 
+            # Answers to the question itself are packed directly from the
+            # addresses packed when the servers were stored; other answers,
+            # and any debug records, go through dnslib.
+            debug = fdns.debug or ('debug' in zone and zone['debug'] == True)
+            direct = not debug and qname == state.qname and \
+                fn == state.reply.add_answer
+
             # Only process the response if it's a list and it has entries
             found = False
             if isinstance(selected, list) and len(selected) > 0:
+                for server in selected:
+                    state.count('Server ' + server['name'], 'selected')
+
+                if direct:
+                    return self._add_packed(state, selected, qtype, ttl)
+
                 for server in selected:
                     # Construct A and AAAA replies for this server
                     if 'ipv4' in server and self._check_qtype(qtype, ('ANY', 'A')):
@@ -494,7 +987,7 @@ class Request(object):
                                 rtype=dnslib.QTYPE.AAAA, ttl=ttl,
                                 rdata=dnslib.AAAA(addr)))
 
-                    if (fdns.debug or ('debug' in zone and zone['debug'] == True)) and self._check_qtype(qtype, ('ANY', 'TXT')):
+                    if debug and self._check_qtype(qtype, ('ANY', 'TXT')):
                         txt = []
                         for item in ('name', 'city'):
                             if item in server:
@@ -509,9 +1002,11 @@ class Request(object):
 
         # Fallthrough if geo stuff doesn't work...
         if 'rr' in zone:
+            state.count(counter, 'fallback')
             return self.handle_static(qname, qtype, zone, state, fn)
 
         # Fallthrough on failure...
+        state.count(counter, 'unanswered')
         return False
 
 
@@ -519,16 +1014,238 @@ class Request(object):
     Called periodically to take care of various housekeeping.
     """
     def idle(self):
-        # Remove any aged cached geo lookups
-        with self.glock:
-            zap = []
-            for k in self.geo_cache:
-                if self.geo_cache[k][0] < time.time():
-                    zap.append(k)
-            for k in zap:
-                del(self.geo_cache[k])
+        # Remove expired entries from the caches; this only looks at the
+        # entries that have expired.
+        now = time.time()
+        if self.geo_cache is not None:
+            self.geo_cache.expire(now)
+        self.packet_shapes.expire(now)
+        self.packet_cache.expire(now)
+
+        if self.snapshot is not None and \
+                now - self._snapshot_time >= fdns.SNAPSHOT_INTERVAL:
+            self.save_snapshot()
 
 
+    """
+    Fetches a pre-packed reply for a query, if there is a current one.
+
+    @param key tuple The (qname, qtype, qclass) of the query; qtype and
+                qclass are numeric.
+    @return tuple The packed reply, with an arbitrary ID, and the counts to
+                add for it; or None.
+    """
+    def _get_compiled(self, key):
+        # Entries are replaced, never modified, so a plain read is safe.
+        entry = self.compiled.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and time.time() >= entry[1]:
+            return None
+        return (entry[0], entry[2])
+
+
+    """
+    Whether the reply to a query can be stored in self.compiled. It can if
+    it was produced only from static zones and the name being queried is
+    itself a zone; the latter keeps junk queries out of the table.
+
+    @param key tuple The (qname, qtype, qclass) of the query.
+    @param state RequestState The state of the resolved query.
+    @return bool True if the reply can be stored.
+    """
+    def _compilable(self, key, state):
+        return state.static and key[0] in self.zones and \
+            key[2] == dnslib.CLASS.IN and key[1] in dnslib.QTYPE.forward
+
+
+    """
+    Stores a pre-packed reply, recording which zones it depends on.
+
+    @param key tuple The (qname, qtype, qclass) of the query.
+    @param packet str The packed reply.
+    @param state RequestState The state of the resolved query.
+    @param generation int The value of self._zone_generation when the
+                query was resolved; if zone data has changed since, the
+                reply is not stored. None skips this check.
+    """
+    def _put_compiled(self, key, packet, state, generation=None):
+        with self.clock:
+            if generation is not None and \
+                    generation != self._zone_generation:
+                return
+            self.compiled[key] = (packet, state.expires, tuple(state.counts))
+            for name in state.zones:
+                if name not in self.compiled_deps:
+                    self.compiled_deps[name] = set()
+                self.compiled_deps[name].add(key)
+
+
+    """
+    Rebuilds the pre-packed replies affected by a change to some zones.
+
+    Replies that depend on the changed zones are dropped and compiled
+    again. Then replies for the changed zones themselves are compiled for
+    each type of record they hold, plus ANY. Replies for other query types
+    are compiled the first time they are asked for.
+
+    @param names list The names of the zones that changed.
+    """
+    def _recompile(self, names):
+        keys = set()
+        with self.clock:
+            self._zone_generation += 1
+            generation = self._zone_generation
+
+            for name in names:
+                for key in self.compiled_deps.pop(name, ()):
+                    if key in self.compiled:
+                        del(self.compiled[key])
+                        keys.add(key)
+
+        for name in names:
+            zone = self.zones.get(name)
+            if zone is None or zone['type'] != 'static':
+                continue
+            qtypes = set(['ANY'])
+            for rr in zone.get('rr', ()):
+                qtypes.add(rr['type'])
+            if 'CNAME' in qtypes:
+                qtypes.update(('A', 'AAAA'))
+            for qtype in qtypes:
+                if hasattr(dnslib.QTYPE, qtype):
+                    keys.add((name, getattr(dnslib.QTYPE, qtype),
+                        dnslib.CLASS.IN))
+
+        for key in keys:
+            request = dnslib.DNSRecord(q=dnslib.DNSQuestion(*key))
+            try:
+                state = self.resolve(request, ('::', 0))
+            except Exception:
+                log.error("Unable to compile %s: %s" %
+                    (repr(key), traceback.format_exc()))
+                continue
+            if self._compilable(key, state):
+                self._put_compiled(key, str(state.reply.pack()), state,
+                    generation)
+
+        if fdns.debug:
+            log.debug("Compiled %d replies for zones %s." %
+                (len(keys), ", ".join(names)))
+
+
+    """
+    Drops the cached replies, and the cached rankings, that depend on some
+    zones or server groups.
+
+    @param tags list Tuples of ('zone', name) or ('group', name).
+    """
+    def _invalidate_packets(self, tags):
+        self.packet_shapes.invalidate(tags)
+        count = self.packet_cache.invalidate(tags)
+        if self.geo_cache is not None:
+            count += self.geo_cache.invalidate(tags)
+        if fdns.debug and count:
+            log.debug("Invalidated %d cached replies for %s." %
+                (count, repr(tags)))
+
+
+    """
+    Adds the counts made for a reply to self.counters.
+
+    @param counts iterable Tuples of (name, counter, n); see
+                RequestState.counts.
+    """
+    def _add_counts(self, counts):
+        for (name, counter, n) in counts:
+            self.counters.add(name, counter, n)
+
+
+    """
+    Returns the counters of the caches in this object, and those of the
+    queries for each zone and of the servers.
+
+    The counters of a zone, 'Zone <name>', are:
+        * queries The number of queries for the name.
+        * cached The number of those answered with a compiled or cached
+            reply. Those are counted as below too, as they were when the
+            reply was built.
+        * errors The number that raised an exception.
+        * refused The number refused.
+        * nodata The number for which the zone had no records.
+    and for geo-dist zones:
+        * default The number of times the zone had no servers so the
+            'default' group was used.
+        * rejected_load, rejected_maxage, rejected_maxdist The number of
+            servers left out, for the reason, of the rankings replies were
+            chosen from. See Geo.rank().
+        * fallback The number of times no server could be chosen so the
+            static records of the zone were used.
+        * unanswered The number of times no server could be chosen and
+            the zone has no static records.
+    Queries for names that are not zones are counted as zone NO_ZONE.
+
+    A server, 'Server <name>', has 'selected', the number of replies with
+    it in.
+
+    @return dict The counters of each cache, zone and server, indexed by
+                name.
+    """
+    def stats(self):
+        stats = self.counters.stats()
+        stats.update({
+            'PacketCache': self.packet_cache.stats(),
+            'Store': self.store.stats(),
+        })
+        stats['Store']['ready'] = 1 if self.ready.is_set() else 0
+        if self.geo_cache is not None:
+            stats['GeoCache'] = self.geo_cache.stats()
+        if self.grid_builder is not None:
+            stats['GeoGrid'] = self.grid_builder.stats()
+        return stats
+
+
+    """
+    Extracts the client IP address from a socket address, stripping the
+    IPv6 part of an IPv4-encoded-as-IPv6 address.
+
+    @param address tuple The socket address.
+    @return str The client IP address.
+    """
+    def _client_address(self, address):
+        client = address[0]
+        if client.startswith('::ffff:'):
+            # strip the ipv6 part
+            client = client[7:]
+        return client
+
+
+    """
+    Returns the EDNS details of a query that a reply could depend on: the
+    advertised UDP payload size and the extended flags of the OPT record.
+
+    @param request DNSRecord The parsed query.
+    @return tuple The details, or None if the query has no OPT record.
+    """
+    def _edns_key(self, request):
+        for rr in request.ar:
+            if rr.rtype == dnslib.QTYPE.OPT:
+                return (rr.rclass, rr.ttl)
+        return None
+
+
+    """
+    Whether an SOA record takes its serial number from the clock.
+
+    @param rr dict The zone information for the SOA record.
+    @return bool True if the serial is "%serial".
+    """
+    def _is_serial_from_time(self, rr):
+        times = rr.get('times')
+        if times is None:
+            times = DEFAULT_SOA_TIMES
+        return str(times[0]) == "%serial"
+
 
     """
     Helper method to check whether a requested qtype is in a list of those
@@ -581,7 +1298,7 @@ class Request(object):
             # a timestamp
             if str(times[0]) == "%serial":
                 times = ( # cheap way to make a new object
-                    int(time.time() / 10),
+                    int(time.time() / SOA_SERIAL_INTERVAL),
                     times[1], times[2], times[3], times[4]
                 )
 
@@ -618,6 +1335,7 @@ class Request(object):
         if rtype in ('MX', 'CNAME', 'NS'):
             # Get the label
             name = str(rdata.label)
+            state.zones.add(name)
             if name in self.zones:
                 fn = None
                 # If we're adding the A/AAAA for an NS record, those are
@@ -635,6 +1353,36 @@ class Request(object):
                 self.handle_zone(name, qtype, state, fn)
 
 
+    """
+    Adds the A and AAAA answers for some servers to state.answers, using
+    their packed addresses, without duplicates.
+
+    @param state RequestState The state tracking object for this request.
+    @param servers list The selected servers.
+    @param qtype str|tuple The record type(s) being asked for.
+    @param ttl int The TTL of the records.
+    @return bool True if any answers were added.
+    """
+    def _add_packed(self, state, servers, qtype, ttl):
+        types = []
+        if self._check_qtype(qtype, ('ANY', 'A')):
+            types.append(('_ipv4', dnslib.QTYPE.A))
+        if self._check_qtype(qtype, ('ANY', 'AAAA')):
+            types.append(('_ipv6', dnslib.QTYPE.AAAA))
+
+        found = False
+        added = set()
+        for server in servers:
+            for (field, rtype) in types:
+                for rdata in server.get(field, ()):
+                    found = True
+                    if rdata in added:
+                        continue
+                    added.add(rdata)
+                    state.answers.append((rtype, ttl, rdata))
+        return found
+
+
     """
     Helper function to add records to the reply but without allowing
     duplicates.
@@ -701,10 +1449,75 @@ class RequestState(object):
     """
     reply = None
 
+    """
+    The names of all zones that were looked up, whether they exist or not.
+    """
+    zones = None
+
+    """
+    Whether the reply was produced only from static zone data, and so
+    would be the same for any client.
+    """
+    static = True
+
+    """
+    The time at which the reply goes stale by itself, or None.
+    """
+    expires = None
+
+    """
+    The server groups the reply depends on.
+    """
+    groups = None
+
+    """
+    The (groups, params) part of each geo_cache key used for the reply.
+    """
+    geo_keys = None
+
+    """
+    Answers for the name being queried that are already packed, as tuples
+    of (rtype, ttl, rdata); see pack_reply().
+    """
+    answers = None
+
+    """
+    The counters to add for the reply, as tuples of (name, counter, n);
+    see Request.stats(). They are added when the reply is sent, and again
+    each time it is sent from a cache.
+    """
+    counts = None
+
 
     def __init__(self):
         super(RequestState, self).__init__()
 
         self.chain = []
         self.added = []
+        self.zones = set()
+        self.groups = set()
+        self.geo_keys = []
+        self.answers = []
+        self.counts = []
+
+
+    """
+    Notes a time at which the reply will go stale, keeping the earliest.
+
+    @param expires float The time.
+    """
+    def expire(self, expires):
+        if self.expires is None or expires < self.expires:
+            self.expires = expires
+
+
+    """
+    Notes a counter to add for the reply; see counts.
+
+    @param name str The thing being counted, such as 'Zone example.com.'.
+    @param counter str The counter for that thing, such as 'fallback'.
+    @param n int The amount to add.
+    """
+    def count(self, name, counter, n=1):
+        self.counts.append((name, counter, n))
 
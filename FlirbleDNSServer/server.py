@@ -20,7 +20,7 @@
 import os, logging
 log = logging.getLogger(os.path.basename(__file__))
 
-import sys, threading, time
+import sys, threading, time, json
 import SocketServer
 
 import FlirbleDNSServer as fdns
@@ -30,18 +30,34 @@ ADDRESS = '::'
 """Default local bind port."""
 PORT = 8053
 
+"""The engines that can be used to serve DNS requests."""
+ENGINES = ('threading', 'eventloop', 'batch')
+"""Default engine."""
+ENGINE = 'threading'
+
+"""Seconds to wait for the zones and servers to load before answering
+   queries anyway; zero waits for as long as it takes."""
+READY_TIMEOUT = 60.0
+
 
 """
 The DNS Server.
 
 Initializes various things then spawns a thread each for the UDP and TCP
-services.
+services, or a single thread for both when the event loop engine is used.
 """
 class Server(object):
 
     """The list of SocketServer instances to launch threads for."""
     servers = None
 
+    """A file to report counters to, one JSON document per line, when run
+    under a Supervisor."""
+    report = None
+
+    """The drop counters of each service when they were last logged."""
+    _dropped = None
+
     """
     Initializes the DNS server.
 
@@ -51,7 +67,11 @@ class Server(object):
                 Geo reference.
 
     Then creates TCP and UDP servers, which opens sockets and binds them
-    to the given address and port.
+    to the given address and port. With the 'threading' engine these are
+    SocketServer based services that hand requests to pools of threads;
+    with the 'eventloop' engine a single EventLoopServer answers both from
+    one thread. The 'batch' engine answers UDP with a BatchUDPServer, and
+    TCP as the 'threading' engine does.
 
     @param rdb FlirbleDNSServer.Data The database object to use.
     @param address str The local address to bind to. Default is "::".
@@ -60,62 +80,185 @@ class Server(object):
     @param server str The servers table to fetch server data from.
     @param geodb str The Maxmind GeoIP database that the Geo class should
                 load. Default is None.
+    @param engine str The engine to serve requests with, one of ENGINES.
+                Default is 'threading'.
+    @param reuse_port bool Set SO_REUSEPORT on the sockets so that several
+                processes can bind the same address and port. Default is
+                False.
+    @param report file A file to periodically write counters to. Default is
+                None.
+    @param snapshot str A file to save the zones and servers to, and to
+                start from when the database is slow or unavailable.
+                Default is None.
     """
     def __init__(self, rdb, address=ADDRESS, port=PORT, zones=None,
-        servers=None, geodb=None):
+        servers=None, geodb=None, engine=ENGINE, reuse_port=False,
+        report=None, snapshot=None):
         super(Server, self).__init__()
 
         log.debug("Initializing Geo module.")
         geo = fdns.Geo(geodb=geodb)
 
         log.debug("Initializing Request module.")
-        request = fdns.Request(rdb=rdb, zones=zones, servers=servers, geo=geo)
+        request = fdns.Request(rdb=rdb, zones=zones, servers=servers, geo=geo,
+            snapshot=snapshot)
 
         self.servers = []
-        log.debug("Initializing UDP server for '%s' port %d." %
-            (address, port))
-        self.servers.append(fdns.UDPServer((address, port),
-            fdns.UDPRequestHandler, request))
-        log.debug("Initializing TCP server for '%s' port %d." %
-            (address, port))
-        self.servers.append(fdns.TCPServer((address, port),
-            fdns.TCPRequestHandler, request))
+        if engine == 'eventloop':
+            log.debug("Initializing event loop server for '%s' port %d." %
+                (address, port))
+            self.servers.append(fdns.EventLoopServer((address, port),
+                request, reuse_port=reuse_port))
+        elif engine in ('threading', 'batch'):
+            log.debug("Initializing UDP server for '%s' port %d." %
+                (address, port))
+            if engine == 'batch':
+                self.servers.append(fdns.BatchUDPServer((address, port),
+                    request, reuse_port=reuse_port))
+            else:
+                self.servers.append(fdns.UDPServer((address, port),
+                    fdns.UDPRequestHandler, request, reuse_port=reuse_port))
+            log.debug("Initializing TCP server for '%s' port %d." %
+                (address, port))
+            self.servers.append(fdns.TCPServer((address, port),
+                fdns.TCPRequestHandler, request, reuse_port=reuse_port))
+        else:
+            raise Exception("Unknown engine '%s'." % engine)
 
         self.request = request
         self.geo = geo
         self.rdb = rdb
+        self.report = report
 
     """
-    Starts the threads and runs the servers. Returns once all services have
-    been stopped, either by Exception or ^C.
+    Starts the threads and runs the servers, once the zones and servers
+    have loaded. Returns once all services have been stopped, either by
+    Exception or ^C.
     """
     def run(self):
-        log.debug("Starting TCP and UDP servers.")
+        started = []
+        try:
+            self.wait_ready()
 
-        # Start the threads.
-        for s in self.servers:
-            thread = threading.Thread(target=s.serve_forever)
-            thread.daemon = True
-            thread.start()
+            log.debug("Starting TCP and UDP servers.")
+
+            # Start the threads.
+            for s in self.servers:
+                thread = threading.Thread(target=s.serve_forever)
+                thread.daemon = True
+                thread.start()
+                started.append(s)
 
-        log.debug("DNS server started.")
+            log.debug("DNS server started.")
 
-        try:
             while True:
                 # This is the idle loop.
                 time.sleep(30)
                 self.request.idle()
+                self.log_stats()
 
         except KeyboardInterrupt:
             pass
         finally:
             log.debug("Shutting down DNS server.")
-            for s in self.servers:
+            # Stopping a service that never started would wait forever
+            for s in started:
                 s.shutdown()
-            self.rdb.stop()
+            self.request.save_snapshot()
+            if self.rdb is not None:
+                self.rdb.stop()
 
 
         self.request = None
         self.geo = None
         self.servers = None
         self.rdb = None
+        self.report = None
+
+
+    """
+    Waits for the zones and servers to load, up to READY_TIMEOUT seconds.
+    Queries that arrive meanwhile wait in the socket buffers.
+
+    @return bool True if they loaded.
+    """
+    def wait_ready(self):
+        if self.request.ready.is_set():
+            return True
+
+        log.info("Waiting for zone and server data to load.")
+        start = time.time()
+        # A plain wait() can't be interrupted with ^C
+        while not self.request.ready.wait(1.0):
+            if fdns.READY_TIMEOUT > 0 and \
+                    time.time() - start >= fdns.READY_TIMEOUT:
+                log.warning("Zone and server data did not load within " \
+                    "%s seconds; answering queries anyway." %
+                    fdns.READY_TIMEOUT)
+                return False
+
+        log.info("Zone and server data loaded in %.2f seconds." %
+            (time.time() - start))
+        return True
+
+
+    """
+    Returns the counters of each service.
+
+    @return dict The stats() of each service, indexed by its class name.
+    """
+    def stats(self):
+        stats = {}
+        for s in self.servers:
+            st = s.stats()
+            if st is not None:
+                stats[s.__class__.__name__] = st
+        stats.update(self.request.stats())
+        if self.rdb is not None:
+            stats[self.rdb.__class__.__name__] = self.rdb.stats()
+        return stats
+
+
+    """
+    Logs the counters of each service. See log_service_stats().
+    """
+    def log_stats(self):
+        if self._dropped is None:
+            self._dropped = {}
+
+        stats = self.stats()
+        log_service_stats(stats, self._dropped)
+
+        if self.report is not None:
+            # Pass them to our supervisor, one JSON document per line
+            try:
+                self.report.write(json.dumps(stats) + "\n")
+                self.report.flush()
+            except (IOError, OSError) as e:
+                log.error("Unable to report stats to supervisor: %s" % e)
+                self.report = None
+
+
+"""
+Logs a set of service counters. Drops are logged as a warning when they
+have increased since the last call, otherwise the counters are logged at
+debug level.
+
+@param stats dict The counters of each service, indexed by name.
+@param dropped dict The drop counter of each service when last logged; this
+            is updated.
+@param prefix str Optional text to prefix each message with.
+"""
+def log_service_stats(stats, dropped, prefix=None):
+    for name in sorted(stats):
+        st = stats[name]
+        msg = "%s%s: %s." % ("" if prefix is None else prefix + " ", name,
+            " ".join(["%s=%d" % (k, st[k]) for k in sorted(st)]))
+
+        d = st.get('dropped', 0)
+        if d > dropped.get(name, 0):
+            log.warning(msg)
+        else:
+            log.debug(msg)
+
+        dropped[name] = d
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# On-disk snapshot of the zones and servers
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import time, traceback
+import cPickle as pickle
+
+import FlirbleDNSServer as fdns
+
+"""The first line of a snapshot file."""
+SNAPSHOT_MAGIC = "FDNS-SNAPSHOT"
+
+"""The version of the snapshot file format, which follows the magic on the
+   first line. Files in any other format are ignored."""
+SNAPSHOT_FORMAT = 1
+
+"""Minimum seconds between snapshots, taken when the data has changed."""
+SNAPSHOT_INTERVAL = 300
+
+
+"""
+Writes the zones and servers of a store to a snapshot file.
+
+The file is a line holding SNAPSHOT_MAGIC and SNAPSHOT_FORMAT, followed by
+a pickled dict of the store version, the time it was written and lists of
+the zone and server records. The records are the frozen ones held by the
+store, so that reading them back needs no conversion. The file is written
+under a temporary name and renamed into place, so readers see either the
+old snapshot or the new one.
+
+@param path str The snapshot file.
+@param zones dict The zones, indexed by name, as held by a Store.
+@param servers dict The servers, indexed by group and then name.
+@param version int The store version of the data.
+@return bool True if the snapshot was written.
+"""
+def save_snapshot(path, zones, servers, version):
+    data = {
+        'version': version,
+        'saved': time.time(),
+        'zones': list(zones.values()),
+        'servers': [server for members in servers.values()
+            for server in members.values()],
+    }
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write("%s %d\n" % (SNAPSHOT_MAGIC, SNAPSHOT_FORMAT))
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except (IOError, OSError, pickle.PicklingError) as e:
+        log.error("Unable to write snapshot '%s': %s" % (path, e))
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+
+    if fdns.debug:
+        log.debug("Wrote snapshot version %d of %d zones and %d servers " \
+            "to '%s'." % (version, len(data['zones']), len(data['servers']),
+            path))
+    return True
+
+
+"""
+Reads a snapshot file written by save_snapshot().
+
+@param path str The snapshot file.
+@return dict With the items 'version', 'saved', 'zones' and 'servers', or
+            None if there is no usable snapshot.
+"""
+def load_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.readline().split()
+            if header != [SNAPSHOT_MAGIC, str(SNAPSHOT_FORMAT)]:
+                log.warning("Ignoring snapshot '%s'; it is not in a format " \
+                    "we know." % path)
+                return None
+            data = pickle.load(f)
+    except (IOError, OSError) as e:
+        if os.path.exists(path):
+            log.error("Unable to read snapshot '%s': %s" % (path, e))
+        return None
+    except Exception:
+        log.error("Unable to read snapshot '%s': %s" %
+            (path, traceback.format_exc()))
+        return None
+
+    return data
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Spatial index of server locations
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import math, heapq, itertools
+
+import FlirbleDNSServer as fdns
+
+"""The smallest CandidateSet that is ranked with the spatial index rather
+   than by looking at every server; zero disables the index."""
+GEO_INDEX_THRESHOLD = 0
+
+"""Miles added to the distances searched, to allow for rounding and for the
+   small differences between the distance modes."""
+GEO_INDEX_MARGIN = 1.0
+
+"""How much deeper than a balanced tree the index may get through updates
+   before it is rebuilt."""
+_SLACK = 4
+
+
+"""
+Converts a distance along the surface of the earth to the length of the
+chord between the two points on a unit sphere. Chord length grows with
+distance, so the nearest points by one are the nearest by the other.
+
+@param miles float The distance, in miles.
+@return float The chord length.
+"""
+def miles_to_chord(miles):
+    angle = min(math.pi, max(0.0, miles / fdns.EARTH_RADIUS_MILES))
+    return 2.0 * math.sin(angle / 2.0)
+
+
+"""
+Converts a chord length on a unit sphere to a distance along the surface
+of the earth; see miles_to_chord().
+
+@param chord float The chord length.
+@return float The distance, in miles.
+"""
+def chord_to_miles(chord):
+    return 2.0 * math.asin(min(1.0, chord / 2.0)) * fdns.EARTH_RADIUS_MILES
+
+
+"""
+A k-d tree of server locations, as unit vectors from the centre of the
+earth, indexed by a key for each server.
+
+Like the zone and server data this is immutable: update() and remove()
+return a new index and leave the old one as it was, so that readers can
+use whichever index they picked up without locking. Only the nodes on the
+path to the change are copied. Removed servers are left in the tree as
+markers and the tree is rebuilt, balanced, when there are too many of
+those or when updates have made it too deep.
+
+Each node is a tuple of (key, vector, axis, left, right); key is None for
+a removed server. Points equal to the split value on the node axis are
+always to the right.
+"""
+class SpatialIndex(object):
+
+    """The root node, or None if the index is empty."""
+    root = None
+
+    """The vector of each key in the index."""
+    vectors = None
+
+    """The number of removed servers left in the tree."""
+    removed = 0
+
+    """The depth of the deepest node."""
+    depth = 0
+
+
+    """
+    @param vectors dict The unit vector of each key, from which to build a
+                balanced tree.
+    """
+    def __init__(self, vectors=None):
+        super(SpatialIndex, self).__init__()
+
+        self.vectors = fdns.FrozenDict(vectors or {})
+        items = [(v, k) for (k, v) in self.vectors.items()]
+        self.root = self._build(items, 0)
+        self.depth = _balanced_depth(len(items))
+
+
+    def __len__(self):
+        return len(self.vectors)
+
+
+    """
+    Returns a new index with a server added or moved.
+
+    @param key object The key of the server.
+    @param lat float The latitude of the server, in degrees.
+    @param lon float The longitude of the server, in degrees.
+    @return SpatialIndex The new index.
+    """
+    def update(self, key, lat, lon):
+        vector = fdns.unit_vector(lat, lon)
+        if self.vectors.get(key) == vector:
+            return self
+
+        index = self.remove(key)
+        vectors = dict(index.vectors)
+        vectors[key] = vector
+
+        (root, depth) = index._insert(index.root, key, vector, 0, 1)
+        depth = max(index.depth, depth)
+        if depth > _balanced_depth(len(vectors)) + _SLACK:
+            return SpatialIndex(vectors)
+
+        return index._derive(root, vectors, index.removed, depth)
+
+
+    """
+    Returns a new index without a server.
+
+    @param key object The key of the server.
+    @return SpatialIndex The new index, or this one if the server is not in
+                it.
+    """
+    def remove(self, key):
+        vector = self.vectors.get(key)
+        if vector is None:
+            return self
+
+        vectors = dict(self.vectors)
+        del(vectors[key])
+        removed = self.removed + 1
+        if removed > len(vectors):
+            return SpatialIndex(vectors)
+
+        root = self._remove(self.root, key, vector)
+        return self._derive(root, vectors, removed, self.depth)
+
+
+    """
+    Generates the servers in order of distance from a point, nearest
+    first, for as long as the caller keeps asking.
+
+    @param vector list The (x, y, z) unit vector of the point.
+    @return generator Tuples of (chord, key); see miles_to_chord().
+    """
+    def nearest(self, vector):
+        (x, y, z) = vector
+        counter = itertools.count()
+        heap = []
+        if self.root is not None:
+            heap.append((0.0, next(counter), False, self.root))
+
+        while len(heap):
+            (d2, _, point, node) = heapq.heappop(heap)
+            if point:
+                yield (math.sqrt(d2), node)
+                continue
+
+            (key, v, axis, left, right) = node
+            if key is not None:
+                p2 = (v[0] - x) ** 2 + (v[1] - y) ** 2 + (v[2] - z) ** 2
+                heapq.heappush(heap, (max(d2, p2), next(counter), True, key))
+
+            diff = vector[axis] - v[axis]
+            (near, far) = (left, right) if diff < 0 else (right, left)
+            if near is not None:
+                heapq.heappush(heap, (d2, next(counter), False, near))
+            if far is not None:
+                heapq.heappush(heap, (max(d2, diff * diff), next(counter),
+                    False, far))
+
+
+    """
+    Returns the servers within a distance of a point.
+
+    @param vector list The (x, y, z) unit vector of the point.
+    @param chord float The maximum distance, as a chord length; see
+                miles_to_chord().
+    @return list The keys of the servers, in no particular order.
+    """
+    def within(self, vector, chord):
+        (x, y, z) = vector
+        limit = chord * chord
+        found = []
+        stack = [self.root]
+        while len(stack):
+            node = stack.pop()
+            if node is None:
+                continue
+
+            (key, v, axis, left, right) = node
+            if key is not None and \
+                    (v[0] - x) ** 2 + (v[1] - y) ** 2 + (v[2] - z) ** 2 <= limit:
+                found.append(key)
+
+            diff = vector[axis] - v[axis]
+            if diff < 0:
+                stack.append(left)
+                if diff * diff <= limit:
+                    stack.append(right)
+            else:
+                stack.append(right)
+                if diff * diff <= limit:
+                    stack.append(left)
+
+        return found
+
+
+    """
+    Makes a new index sharing the unchanged parts of this one.
+    """
+    def _derive(self, root, vectors, removed, depth):
+        index = SpatialIndex.__new__(SpatialIndex)
+        index.root = root
+        index.vectors = fdns.FrozenDict(vectors)
+        index.removed = removed
+        index.depth = depth
+        return index
+
+
+    """
+    Builds a balanced tree.
+
+    @param items list Tuples of (vector, key).
+    @param axis int The axis to split on at this level.
+    @return tuple The root node.
+    """
+    def _build(self, items, axis):
+        if len(items) == 0:
+            return None
+
+        items = sorted(items, key=lambda item: item[0][axis])
+        mid = len(items) // 2
+        # Anything equal to the split value must go to the right
+        while mid > 0 and items[mid - 1][0][axis] == items[mid][0][axis]:
+            mid -= 1
+
+        (vector, key) = items[mid]
+        following = (axis + 1) % 3
+        return (key, vector, axis, self._build(items[:mid], following),
+            self._build(items[mid + 1:], following))
+
+
+    """
+    Adds a point below a node, copying the nodes on the way down.
+
+    @return tuple The new node and the depth the point was added at.
+    """
+    def _insert(self, node, key, vector, axis, depth):
+        if node is None:
+            return ((key, vector, axis, None, None), depth)
+
+        (k, v, a, left, right) = node
+        if vector[a] < v[a]:
+            (left, depth) = self._insert(left, key, vector, (a + 1) % 3,
+                depth + 1)
+        else:
+            (right, depth) = self._insert(right, key, vector, (a + 1) % 3,
+                depth + 1)
+        return ((k, v, a, left, right), depth)
+
+
+    """
+    Marks a point below a node as removed, copying the nodes on the way
+    down.
+
+    @return tuple The new node.
+    """
+    def _remove(self, node, key, vector):
+        if node is None:
+            return None
+
+        (k, v, a, left, right) = node
+        if k == key and v == vector:
+            return (None, v, a, left, right)
+        if vector[a] < v[a]:
+            return (k, v, a, self._remove(left, key, vector), right)
+        return (k, v, a, left, self._remove(right, key, vector))
+
+
+"""
+The depth of a balanced tree of some number of points.
+"""
+def _balanced_depth(count):
+    return int(math.ceil(math.log(count + 1, 2)))
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Zone and server store
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import time, socket
+
+import FlirbleDNSServer as fdns
+
+"""Server fields that change all the time, as load reports come in. A
+   change to only these does not change which servers a client can be
+   given, nor what goes in the replies; see StoreDelta.structural."""
+VOLATILE_SERVER_FIELDS = ('load', 'ts')
+
+
+"""
+Works out the group a server belongs to, and its name in that group, from
+the name it is stored under. A name without a group implies a group with
+the same name as the server.
+
+@param name str The stored name, "group,name", "group!name" or "name".
+@return tuple The (group, name).
+"""
+def server_key(name):
+    if ',' in name:
+        return tuple(name.split(',', 1))
+    if '!' in name:
+        return tuple(name.split('!', 1))
+    return (name, name)
+
+
+"""
+Parses the 'groups' value of a zone. This may be a comma-separated
+string, a list or a single group name.
+
+@param groups str|list The value from the zone.
+@return tuple The group names.
+"""
+def parse_groups(groups):
+    if isinstance(groups, list) or isinstance(groups, tuple):
+        return tuple(groups)
+    if "," in groups:
+        return tuple(groups.split(","))
+    return (groups,)
+
+
+"""
+Packs the addresses of a server as they go in A and AAAA records.
+
+@param addrs str|list The 'ipv4' or 'ipv6' value of the server.
+@param family int socket.AF_INET or socket.AF_INET6.
+@param name str The name of the server, for logging.
+@return tuple The packed addresses. Any that can not be parsed are left
+            out.
+"""
+def pack_addresses(addrs, family, name):
+    if not isinstance(addrs, (list, tuple)):
+        addrs = (addrs,)
+
+    packed = []
+    for addr in addrs:
+        try:
+            packed.append(socket.inet_pton(family, str(addr)))
+        except (socket.error, UnicodeError):
+            log.warning("Ignoring address '%s' of server '%s'; it is not " \
+                "valid." % (addr, name))
+    return tuple(packed)
+
+
+"""
+The zones and servers, kept up to date from a stream of changes.
+
+Changes are given in the form RethinkDB changefeeds use: a dict with
+'new_val', the record as it now is or None if it was deleted, and
+'old_val', the record as it was if there was one. Each record is looked up
+by its name, and compared with what the store already holds rather than
+with 'old_val', so a change that has already been applied, or a record
+repeated when a feed starts over, changes nothing.
+
+The zones and servers are immutable snapshots, like everything else read
+while answering queries: apply() builds new ones and swaps the references,
+so readers can take a reference and use it without locking. apply() itself
+is not thread safe; the caller must serialize changes.
+
+Every change that does something bumps the store version, and the zones
+and groups it touched are stamped with that version.
+"""
+class Store(object):
+
+    """The zones, indexed by name. Zones with a 'groups' value also have
+    '_groups', the parsed tuple of group names."""
+    zones = None
+
+    """The servers, indexed by group and then name. Servers with 'ipv4' or
+    'ipv6' values also have '_ipv4' or '_ipv6', the tuple of addresses
+    packed by pack_addresses()."""
+    servers = None
+
+    """The version of the store after the most recent change."""
+    version = 0
+
+    """The version at which each zone and each group last changed. Deleted
+    zones and emptied groups keep their entry, so their removal has a
+    version too."""
+    zone_versions = None
+    group_versions = None
+
+    """Counters; see stats()."""
+    inserts = 0
+    updates = 0
+    deletes = 0
+    unchanged = 0
+
+
+    def __init__(self):
+        super(Store, self).__init__()
+
+        self.zones = fdns.FrozenDict()
+        self.servers = fdns.FrozenDict()
+        self.zone_versions = fdns.FrozenDict()
+        self.group_versions = fdns.FrozenDict()
+
+
+    """
+    Applies changes to the zones and servers and publishes the result.
+
+    @param zones list Changes to the zones table.
+    @param servers list Changes to the servers table.
+    @return StoreDelta What changed.
+    """
+    def apply(self, zones=(), servers=()):
+        delta = StoreDelta()
+
+        if len(zones):
+            new_zones = dict(self.zones)
+            for change in zones:
+                self._apply_zone(new_zones, change, delta)
+
+        if len(servers):
+            new_servers = {}
+            for change in servers:
+                self._apply_server(new_servers, change, delta)
+
+        if delta.empty():
+            delta.version = self.version
+            return delta
+
+        self.version += 1
+        delta.version = self.version
+
+        if len(delta.zones):
+            versions = dict(self.zone_versions)
+            for name in delta.zones:
+                versions[name] = self.version
+            self.zone_versions = fdns.FrozenDict(versions)
+            self.zones = fdns.FrozenDict(new_zones)
+
+        if len(delta.groups):
+            versions = dict(self.group_versions)
+            for group in delta.groups:
+                versions[group] = self.version
+            self.group_versions = fdns.FrozenDict(versions)
+
+            # Only the groups that changed are copied
+            snapshot = dict(self.servers)
+            for (group, members) in new_servers.items():
+                if len(members):
+                    snapshot[group] = fdns.FrozenDict(members)
+                else:
+                    snapshot.pop(group, None)
+            self.servers = fdns.FrozenDict(snapshot)
+
+        return delta
+
+
+    """
+    Returns the changes that remove the zones not among a complete set of
+    zones, such as a table that has been loaded again.
+
+    @param zones list The zone records.
+    @return list Changes that delete the other zones.
+    """
+    def zone_removals(self, zones):
+        names = set([zone['name'] for zone in zones])
+        return [{'old_val': zone, 'new_val': None}
+            for zone in self.zones.values() if zone['name'] not in names]
+
+
+    """
+    Returns the changes that remove the servers not among a complete set
+    of servers; see zone_removals().
+
+    @param servers list The server records.
+    @return list Changes that delete the other servers.
+    """
+    def server_removals(self, servers):
+        keys = set([server_key(server['name']) for server in servers])
+        return [{'old_val': server, 'new_val': None}
+            for members in self.servers.values()
+            for server in members.values()
+            if server_key(server['name']) not in keys]
+
+
+    """
+    Returns a snapshot of the store counters.
+
+    @return dict With these items:
+                * zones The number of zones.
+                * servers The number of servers.
+                * inserts The number of records added.
+                * updates The number of records changed.
+                * deletes The number of records removed.
+                * unchanged The number of changes that changed nothing.
+    """
+    def stats(self):
+        return {
+            'zones': len(self.zones),
+            'servers': sum([len(g) for g in self.servers.values()]),
+            'inserts': self.inserts,
+            'updates': self.updates,
+            'deletes': self.deletes,
+            'unchanged': self.unchanged,
+        }
+
+
+    """
+    Applies one change to a copy of the zones.
+    """
+    def _apply_zone(self, zones, change, delta):
+        new = change.get('new_val')
+        old = change.get('old_val')
+
+        if new is not None:
+            # Parse the servers group list once, here
+            if 'groups' in new:
+                new = dict(new)
+                new['_groups'] = parse_groups(new['groups'])
+            new = fdns.freeze(new)
+
+        # A renamed zone is gone from under its old name
+        if old is not None and (new is None or old['name'] != new['name']):
+            if zones.pop(old['name'], None) is not None:
+                delta.zones.add(old['name'])
+                self.deletes += 1
+
+        if new is None:
+            return
+
+        current = zones.get(new['name'])
+        if current == new:
+            self.unchanged += 1
+            return
+
+        zones[new['name']] = new
+        delta.zones.add(new['name'])
+        if current is None:
+            self.inserts += 1
+        else:
+            self.updates += 1
+
+
+    """
+    Applies one change to the servers, copying each group it touches into
+    'servers' the first time.
+    """
+    def _apply_server(self, servers, change, delta):
+        new = change.get('new_val')
+        old = change.get('old_val')
+        if new is not None:
+            # Pack the addresses once, here, rather than for every reply
+            if 'ipv4' in new or 'ipv6' in new:
+                new = dict(new)
+                if 'ipv4' in new:
+                    new['_ipv4'] = pack_addresses(new['ipv4'],
+                        socket.AF_INET, new['name'])
+                if 'ipv6' in new:
+                    new['_ipv6'] = pack_addresses(new['ipv6'],
+                        socket.AF_INET6, new['name'])
+            new = fdns.freeze(new)
+
+        if old is not None and (new is None or old['name'] != new['name']):
+            (group, name) = server_key(old['name'])
+            members = self._members(servers, group)
+            current = members.pop(name, None)
+            if current is not None:
+                delta.server(group, name, current, None)
+                self.deletes += 1
+
+        if new is None:
+            return
+
+        (group, name) = server_key(new['name'])
+        members = self._members(servers, group)
+        current = members.get(name)
+
+        # If the timestamp is missing, add one; unless this is what we
+        # already have, in which case it is not news
+        if 'ts' not in new:
+            if current is not None and \
+                    dict([i for i in current.items() if i[0] != 'ts']) == new:
+                new = current
+            else:
+                new = dict(new)
+                new['ts'] = time.time()
+                new = fdns.FrozenDict(new)
+
+        if current == new:
+            self.unchanged += 1
+            return
+
+        if fdns.debug:
+            log.debug("Updating group '%s' server '%s'." % (group, name))
+
+        members[name] = new
+        delta.server(group, name, current, new)
+        if current is None:
+            self.inserts += 1
+        else:
+            self.updates += 1
+
+
+    """
+    Returns the working copy of the members of a group.
+    """
+    def _members(self, servers, group):
+        if group not in servers:
+            servers[group] = dict(self.servers.get(group, {}))
+        return servers[group]
+
+
+"""
+The changes made by one Store.apply(), which tells the caller which of the
+things it derives from the store, and which cached replies, are affected.
+"""
+class StoreDelta(object):
+
+    """The version of the store after the change."""
+    version = None
+
+    """The names of the zones that were added, changed or removed."""
+    zones = None
+
+    """The groups with any server added, changed or removed."""
+    groups = None
+
+    """The groups whose servers were added, removed, or changed in more
+    than their VOLATILE_SERVER_FIELDS. Results cached for these groups
+    must be dropped; those for the other groups only differ in load, and
+    are left to expire."""
+    structural = None
+
+    """The servers that changed, as a dict indexed by (group, name) of
+    (old, new) records; old is None if the server was added and new is None
+    if it was removed."""
+    servers = None
+
+
+    def __init__(self):
+        super(StoreDelta, self).__init__()
+
+        self.zones = set()
+        self.groups = set()
+        self.structural = set()
+        self.servers = {}
+
+
+    """
+    Records a change to a server, folding it into any earlier change to
+    the same server.
+    """
+    def server(self, group, name, old, new):
+        key = (group, name)
+        if key in self.servers:
+            old = self.servers[key][0]
+        if old is None and new is None:
+            del(self.servers[key])
+        else:
+            self.servers[key] = (old, new)
+
+        self.groups.add(group)
+        if old is None or new is None or \
+                _static_fields(old) != _static_fields(new):
+            self.structural.add(group)
+
+
+    """
+    Whether nothing changed.
+
+    @return bool True if nothing changed.
+    """
+    def empty(self):
+        return len(self.zones) == 0 and len(self.groups) == 0
+
+
+"""
+The fields of a server record other than VOLATILE_SERVER_FIELDS.
+"""
+def _static_fields(server):
+    return dict([(k, v) for (k, v) in server.items()
+        if k not in VOLATILE_SERVER_FIELDS])
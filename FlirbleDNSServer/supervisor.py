@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Multi-process supervisor
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import sys, time, json, errno, signal, select, traceback
+
+import FlirbleDNSServer as fdns
+
+"""Seconds between logging the combined counters of all workers."""
+SUPERVISOR_STATS_INTERVAL = 30
+
+"""Minimum seconds between restarts of the same worker slot, so that a
+   worker that dies at startup does not spin."""
+SUPERVISOR_RESTART_DELAY = 1.0
+
+"""Counters that describe the current state rather than a running total;
+   these are not carried over from workers that have exited."""
+GAUGE_COUNTERS = ('workers', 'depth', 'max_depth', 'connections', 'entries',
+    'pending', 'zones', 'servers', 'ready', 'connected', 'max_lag_ms',
+    'max_batch')
+
+
+"""
+Runs several DNS server processes that share the same address and port.
+
+Each worker process binds its sockets with SO_REUSEPORT so that the kernel
+spreads the queries across them, which gets around the GIL limiting a
+single process to one core. Every worker has its own database connection,
+changefeeds, zone and server state and Geo database; nothing is shared with
+the supervisor or the other workers.
+
+The supervisor restarts workers that exit and periodically logs the
+counters of all workers combined. Workers report their counters over a pipe
+from their idle loop.
+"""
+class Supervisor(object):
+
+    """The number of worker processes to run."""
+    processes = None
+
+    """Keyword arguments for the Data object of each worker."""
+    rdb_args = None
+
+    """The class of the Data object of each worker."""
+    data_class = None
+
+    """Keyword arguments for the Server object of each worker."""
+    server_args = None
+
+    """The state of each worker slot: pid, report pipe, latest counters."""
+    workers = None
+
+    """The summed counters of workers that have exited."""
+    retired = None
+
+    """The drop counters of each service when they were last logged."""
+    _dropped = None
+
+    """Whether we should keep running."""
+    _running = False
+
+
+    """
+    @param processes int The number of worker processes to run.
+    @param rdb_args dict Keyword arguments used to create a Data object in
+                each worker, or None to run without a database.
+    @param server_args dict Keyword arguments used to create a Server
+                object in each worker. The 'reuse_port' and 'report'
+                arguments are provided by the supervisor.
+    @param data_class class The class to create the Data object of each
+                worker with, such as FileData. Default is Data.
+    """
+    def __init__(self, processes, rdb_args, server_args, data_class=None):
+        super(Supervisor, self).__init__()
+
+        self.processes = processes
+        self.rdb_args = rdb_args
+        self.server_args = server_args
+        self.data_class = data_class or fdns.Data
+
+        self.workers = []
+        for i in range(processes):
+            self.workers.append({
+                'pid': None,
+                'pipe': None,
+                'buf': '',
+                'stats': None,
+                'started': 0.0,
+            })
+        self.retired = {}
+        self._dropped = {}
+
+
+    """
+    Starts the workers and supervises them. Returns once asked to stop,
+    either by ^C or SIGTERM, after stopping the workers.
+    """
+    def run(self):
+        self._running = True
+
+        def _stop(signum, frame):
+            self._running = False
+        signal.signal(signal.SIGTERM, _stop)
+
+        log.info("Starting %d DNS server processes." % self.processes)
+
+        next_stats = time.time() + SUPERVISOR_STATS_INTERVAL
+
+        try:
+            while self._running:
+                self._reap()
+
+                for slot in range(len(self.workers)):
+                    if self.workers[slot]['pid'] is None:
+                        self._spawn(slot)
+
+                self._read_reports(1.0)
+
+                now = time.time()
+                if now >= next_stats:
+                    fdns.log_service_stats(self.stats(), self._dropped,
+                        prefix="All workers")
+                    next_stats = now + SUPERVISOR_STATS_INTERVAL
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._running = False
+            self._stop_workers()
+
+
+    """
+    Returns the counters of all workers combined, including the running
+    totals of workers that have since exited.
+
+    @return dict The summed counters of each service, indexed by name.
+    """
+    def stats(self):
+        total = {}
+        self._merge(total, self.retired)
+        for w in self.workers:
+            if w['stats'] is not None:
+                self._merge(total, w['stats'])
+        return total
+
+
+    """
+    Adds a set of service counters to a running total. Counters named
+    'max_*' take the maximum rather than the sum.
+
+    @param total dict The totals, indexed by service name; this is updated.
+    @param stats dict The counters to add, indexed by service name.
+    @param gauges bool Whether to include GAUGE_COUNTERS.
+    """
+    def _merge(self, total, stats, gauges=True):
+        for name in stats:
+            t = total.setdefault(name, {})
+            for (k, v) in stats[name].items():
+                if not gauges and k in GAUGE_COUNTERS:
+                    continue
+                if k.startswith('max_'):
+                    t[k] = max(t.get(k, 0), v)
+                else:
+                    t[k] = t.get(k, 0) + v
+
+
+    """
+    Forks a worker process into a slot.
+
+    @param slot int The index of the slot in self.workers.
+    """
+    def _spawn(self, slot):
+        w = self.workers[slot]
+
+        # Don't restart too quickly
+        delay = w['started'] + SUPERVISOR_RESTART_DELAY - time.time()
+        if delay > 0:
+            return
+
+        (r, wr) = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            # The worker
+            os.close(r)
+            for other in self.workers:
+                if other['pipe'] is not None:
+                    os.close(other['pipe'])
+            code = 0
+            try:
+                self._worker(slot, os.fdopen(wr, 'w'))
+            except:
+                log.error("Worker %d exception: %s" %
+                    (slot, traceback.format_exc()))
+                code = 1
+            os._exit(code)
+
+        os.close(wr)
+        w['pid'] = pid
+        w['pipe'] = r
+        w['buf'] = ''
+        w['stats'] = None
+        w['started'] = time.time()
+        log.info("Started DNS server worker %d as pid %d." % (slot, pid))
+
+
+    """
+    The body of a worker process. Connects to the database and runs a
+    Server until told to stop.
+
+    @param slot int The index of this worker.
+    @param report file The pipe to report counters to the supervisor on.
+    """
+    def _worker(self, slot, report):
+        # Turn SIGTERM into the same clean exit as ^C
+        def _stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, _stop)
+
+        rdb = None
+        if self.rdb_args is not None:
+            rdb = self.data_class(**self.rdb_args)
+            if rdb.start() == False:
+                snapshot = self.server_args.get('snapshot')
+                if snapshot is None or not os.path.isfile(snapshot):
+                    raise Exception("Worker %d failed to start its data " \
+                        "source." % slot)
+                # The data source keeps trying in the background
+                log.warning("Worker %d serving from snapshot '%s' " \
+                    "until its data source is available." % (slot, snapshot))
+
+        args = dict(self.server_args)
+        args['reuse_port'] = True
+        args['report'] = report
+
+        server = fdns.Server(rdb, **args)
+        server.run()
+
+
+    """
+    Collects exited workers, keeping their running totals.
+    """
+    def _reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            for (slot, w) in enumerate(self.workers):
+                if w['pid'] != pid:
+                    continue
+
+                if self._running:
+                    log.error("DNS server worker %d (pid %d) exited with " \
+                        "status %d; restarting it." % (slot, pid, status))
+
+                if w['stats'] is not None:
+                    self._merge(self.retired, w['stats'], gauges=False)
+                os.close(w['pipe'])
+                w['pid'] = None
+                w['pipe'] = None
+                w['stats'] = None
+
+
+    """
+    Reads any counters the workers have reported.
+
+    @param timeout float How long to wait for a report.
+    """
+    def _read_reports(self, timeout):
+        fds = {}
+        for w in self.workers:
+            if w['pipe'] is not None:
+                fds[w['pipe']] = w
+
+        try:
+            (readable, _, _) = select.select(fds.keys(), [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            w = fds[fd]
+            data = os.read(fd, 65536)
+            if len(data) == 0:
+                # The worker has gone; _reap() will tidy up
+                continue
+
+            w['buf'] += data
+            while "\n" in w['buf']:
+                (line, w['buf']) = w['buf'].split("\n", 1)
+                try:
+                    w['stats'] = json.loads(line)
+                except ValueError:
+                    log.error("Bad stats report from pid %d." % w['pid'])
+
+
+    """
+    Asks all workers to stop and waits for them to exit.
+    """
+    def _stop_workers(self):
+        log.info("Stopping DNS server processes.")
+        for w in self.workers:
+            if w['pid'] is not None:
+                try:
+                    os.kill(w['pid'], signal.SIGTERM)
+                except OSError:
+                    pass
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self._reap()
+            if all([w['pid'] is None for w in self.workers]):
+                return
+            time.sleep(0.1)
+
+        for w in self.workers:
+            if w['pid'] is not None:
+                log.error("Killing DNS server worker pid %d." % w['pid'])
+                try:
+                    os.kill(w['pid'], signal.SIGKILL)
+                except OSError:
+                    pass
+        self._reap()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Flirble DNS Server
+# Reading and writing DNS packets without dnslib
+#
+#    Copyright 2016 Chris Luke
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os, logging
+log = logging.getLogger(os.path.basename(__file__))
+
+import struct
+
+from dnslib.label import DNSBuffer
+
+import FlirbleDNSServer as fdns
+
+"""The DNS header: ID, flags and the four section counts."""
+_HEADER = struct.Struct('!HHHHHH')
+
+"""The question type and class, and the fixed part of a resource record
+   after its name: type, class, TTL and data length."""
+_QUESTION = struct.Struct('!HH')
+_RR = struct.Struct('!HHIH')
+
+"""The QR bit and the opcode in the header flags."""
+_QR_OPCODE = 0xf800
+
+"""The type of an EDNS OPT record."""
+_OPT = 41
+
+"""A compression pointer to the name of the first question, which always
+   follows the header."""
+_QNAME_POINTER = '\xc0\x0c'
+
+"""The IN class."""
+_IN = 1
+
+"""Bytes that dnslib shows as they are in a name; labels with any other
+   byte are escaped, so those queries are left to dnslib."""
+_PLAIN = ''.join([chr(c) for c in range(33, 127)])
+
+
+"""
+Reads the question from a DNS query, for looking up a ready-made reply,
+without building a dnslib.DNSRecord.
+
+Only the most common form of query is read: a standard query with one
+question whose name is not compressed and is made of printable characters,
+no answer or authority records and at most an EDNS OPT record. The name is
+given as dnslib would show it, so that the results match those of
+dnslib.DNSRecord.parse(). Anything else, including malformed packets, is
+left to dnslib.
+
+@param data str|buffer A raw DNS datagram.
+@return tuple The (id, qname, qtype, qclass, edns) of the query, where
+            edns is the (udp payload size, extended flags) of the OPT
+            record or None if there is none; or None if the query must be
+            parsed by dnslib.
+"""
+def parse_question(data):
+    view = memoryview(data)
+    length = len(view)
+    if length < 17:
+        return None
+
+    (qid, flags, qdcount, ancount, nscount, arcount) = \
+        _HEADER.unpack_from(view, 0)
+    if flags & _QR_OPCODE or qdcount != 1 or ancount or nscount or \
+            arcount > 1:
+        return None
+
+    # The labels of the name, up to the root; pointers and the extended
+    # label types are both caught by l > 63
+    labels = []
+    i = 12
+    while True:
+        if i >= length:
+            return None
+        l = ord(view[i])
+        if l == 0:
+            break
+        if l > 63 or i + 1 + l > length:
+            return None
+        label = view[i + 1:i + 1 + l].tobytes()
+        if len(label.translate(None, _PLAIN)):
+            return None
+        labels.append(label)
+        i += 1 + l
+    i += 1
+
+    if i + 4 > length:
+        return None
+    (qtype, qclass) = _QUESTION.unpack_from(view, i)
+    i += 4
+
+    edns = None
+    if arcount:
+        # The OPT record has the root as its name
+        if i + 11 > length or ord(view[i]) != 0:
+            return None
+        (rtype, rclass, ttl, rdlength) = _RR.unpack_from(view, i + 1)
+        if rtype != _OPT:
+            return None
+        edns = (rclass, ttl)
+        i += 11 + rdlength
+
+    if i != length:
+        return None
+
+    return (qid, '.'.join(labels) + '.', qtype, qclass, edns)
+
+
+"""
+Packs a reply, with answers for the name of the question that have
+already been packed.
+
+The header and question are packed by dnslib, followed by the packed
+answers, each named with a pointer to the question, then the records in
+the reply itself, packed by dnslib into the same buffer so that their
+names are compressed as usual.
+
+@param reply dnslib.DNSRecord The reply, with its question and any records
+            other than the packed answers.
+@param answers list Tuples of (rtype, ttl, rdata), rtype being numeric and
+            rdata the packed record data, of IN answers for the name of the
+            first question.
+@return str The packed reply.
+"""
+def pack_reply(reply, answers=()):
+    if len(answers) == 0:
+        return str(reply.pack())
+
+    reply.set_header_qa()
+    reply.header.a += len(answers)
+
+    buffer = DNSBuffer()
+    reply.header.pack(buffer)
+    for q in reply.questions:
+        q.pack(buffer)
+    for rr in reply.rr:
+        rr.pack(buffer)
+    for (rtype, ttl, rdata) in answers:
+        buffer.append(_QNAME_POINTER +
+            _RR.pack(rtype, _IN, ttl, len(rdata)) + rdata)
+    for rr in reply.auth:
+        rr.pack(buffer)
+    for rr in reply.ar:
+        rr.pack(buffer)
+
+    return str(buffer.data)
@@ -64,8 +64,9 @@ setup(name='FlirbleDNSServer',
       url = 'https://git.flirble.org/flirble-lb/flirble-dns-server',
       packages = ['FlirbleDNSServer'],
       package_dir = {'FlirbleDNSServer': 'FlirbleDNSServer'},
-      scripts = ['fdnsd', 'fdnsd-run', 'fdns-init-rethinkdb', 'fdns-update-server'],
-      requires = ['dnslib (>=0.9.2)', 'geoip2 (>=2.2.0)', 'lockfile (>=0.12.2)', 'rethinkdb (>=2.2.0)'],
+      scripts = ['fdnsd', 'fdnsd-run', 'fdns-init-rethinkdb', 'fdns-update-server',
+                 'fdns-bench-parse', 'fdns-bench-geodistance'],
+      requires = ['dnslib (>=0.9.2)', 'geoip2 (>=2.2.0)', 'maxminddb (>=1.5.0)', 'lockfile (>=0.12.2)', 'rethinkdb (>=2.2.0)'],
       license = 'Apache-2.0',
       classifiers = [ "Topic :: Internet :: Name Service (DNS)",
                       "Programming Language :: Python :: 2",